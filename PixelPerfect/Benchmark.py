@@ -0,0 +1,254 @@
+"""
+Per-stage encoder and decoder benchmarks over media/CIF.yuv and media/QCIF.yuv.
+
+Every configuration of the matrix is encoded once. Each stage is then timed on its own, on the
+frames, references and packets of that encode: motion estimation (P frames, and every frame of
+the first pass of rate control 2 and 3), intra prediction (mode decision of I frames), transform
+and quantization, entropy coding, reconstruction (entropy decoding,
+de-quantization and inverse transform), and decoding of the whole stream. Stages are run
+`repeat` times and the fastest run is kept.
+
+    python -m PixelPerfect.Benchmark run results.json
+    python -m PixelPerfect.Benchmark compare baseline.json results.json --threshold 0.1
+"""
+import argparse
+import copy
+import itertools
+import json
+import os
+import sys
+import time
+from typing import Deque
+import numpy as np
+from PixelPerfect.CodecConfig import CodecConfig
+from PixelPerfect.Encoder import VideoEncoder, InterFrameEncoder, IntraFrameEncoder
+from PixelPerfect.Decoder import VideoDecoder
+from PixelPerfect.Bitstream import get_descriptors_per_residual
+from PixelPerfect.FileIO import read_frames, get_media_file_path, read_json
+
+VIDEOS = {
+    "QCIF": ("QCIF.yuv", 144, 176, 960),
+    "CIF": ("CIF.yuv", 288, 352, 2400),
+}
+BASE_CONFIG = dict(block_size=16, block_search_offset=4, i_Period=4, qp=4, RD_lambda=0.3, FastME_LIMIT=16)
+MATRIX = {
+    "FastME": [False, True],
+    "PyramidME": [False, True],
+    "FMEEnable": [False, True],
+    "VBSEnable": [False, True],
+    "nRefFrames": [1, 2, 3, 4],
+    "do_entropy": [False, True],
+    "RCflag": [0, 1, 2, 3],
+}
+# settings the coder rejects together
+EXCLUSIVE = [("FastME", "PyramidME")]
+RC_TABLE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "e1_table.json")
+STAGES = ["motion_estimation", "intra_prediction", "transform_quant", "entropy_coding", "reconstruction", "decoding"]
+
+
+def get_matrix(full=False):
+    # one axis at a time around the first value of every axis, or every combination
+    if full:
+        points = [dict(zip(MATRIX, values)) for values in itertools.product(*MATRIX.values())]
+    else:
+        base = {name: values[0] for name, values in MATRIX.items()}
+        points = [base]
+        for name, values in MATRIX.items():
+            points += [dict(base, **{name: value}) for value in values[1:]]
+    return [point for point in points if not any(point[first] and point[second] for first, second in EXCLUSIVE)]
+
+
+def get_point_name(point):
+    return ",".join(f"{name}={int(value)}" for name, value in point.items())
+
+
+def create_config(video_name, point, frame_count):
+    _, _, _, target_bitrate = VIDEOS[video_name]
+    config = CodecConfig(**BASE_CONFIG, **point)
+    if config.RCflag > 0:
+        config.RCTable = read_json(RC_TABLE_PATH)[video_name]
+        config.targetBR = target_bitrate
+        config.total_frames = frame_count
+        config.filename = video_name
+    return config
+
+
+def get_best_time(function, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+class StageBenchmark:
+    def __init__(self, video_name, point, frame_count, repeat) -> None:
+        filename, self.height, self.width, _ = VIDEOS[video_name]
+        self.config = create_config(video_name, point, frame_count)
+        self.repeat = repeat
+        self.frames = list(read_frames(get_media_file_path(filename), self.height, self.width, self.config, stop=frame_count))
+        # what the encoder saw and produced for every frame, with the references and motion field tables
+        # of the first pass of rate control 2 and 3
+        self.references, self.packets, self.reconstructions = [], [], []
+        self.first_pass_references, self.seed_tables = [], []
+        encoder = VideoEncoder(self.height, self.width, copy.deepcopy(self.config))
+        start = time.perf_counter()
+        for frame in self.frames:
+            self.references.append(Deque(encoder.previous_frames, maxlen=encoder.previous_frames.maxlen))
+            if self.config.RCflag > 1:
+                first_pass_frames = encoder.firstpass_encoder.previous_frames
+                self.first_pass_references.append(Deque(first_pass_frames, maxlen=first_pass_frames.maxlen))
+            self.packets.append(encoder.process(frame))
+            self.reconstructions.append(encoder.previous_frames[-1])
+            self.seed_tables.append(encoder.seed_tables)
+        self.encode_time = time.perf_counter() - start
+        self.first_pass_config = encoder.firstpass_encoder.config if self.config.RCflag > 1 else None
+        encoder.close()
+        self.coder = VideoDecoder(self.height, self.width, copy.deepcopy(self.config))
+
+    def get_packet_residuals(self, packet):
+        # layout of the residuals of a packet and the residuals as they are before entropy coding
+        compressed_residual, compressed_descriptors, qp_list, frame_seq = packet[:4]
+        self.coder.frame_seq = frame_seq
+        count = get_descriptors_per_residual(self.config, self.coder.is_p_frame()) * len(compressed_residual)
+        descriptors = self.coder.decompress_descriptors(compressed_descriptors, count)
+        layout, _ = self.coder.get_block_predictions(descriptors, qp_list, len(compressed_residual))
+        quantized = compressed_residual
+        if self.config.do_entropy:
+            quantized = []
+            for residual, (_, _, is_sub_block, _) in zip(compressed_residual, layout):
+                block_size = self.config.sub_block_size if is_sub_block else self.config.block_size
+                quantized.append(self.coder.dediagonalize_sequence(self.coder.Entrophy_decoding(residual, block_size), block_size))
+        return layout, descriptors, quantized
+
+    def run_motion_estimation(self, frame, references, config, seed_tables=None):
+        frame_encoder = InterFrameEncoder(self.height, self.width, references, config)
+        frame_encoder.prepare_motion_field(frame, seed_tables)
+        for block in frame.get_blocks():
+            frame_encoder.get_inter_data(block, 0, 0)
+            if config.VBSEnable:
+                for sub_block in block.get_sub_blocks():
+                    frame_encoder.get_inter_data(sub_block, 0, 0)
+
+    def run_intra_prediction(self, frame, reconstruction):
+        # the intra prediction the encoder runs for the config, neighbours come from a copy of the reconstruction
+        frame_encoder = IntraFrameEncoder(self.height, self.width, self.config, frame.data)
+        frame_encoder.intra_decoder.frame.data[:] = reconstruction.data
+        block_sizes = [self.config.block_size] + ([self.config.sub_block_size] if self.config.VBSEnable else [])
+        if self.config.RCflag == 0:
+            # the batches of the wavefront, every neighbour is already there so a block size is one batch
+            for block_size in block_sizes:
+                rows, cols = np.meshgrid(np.arange(0, frame.height, block_size), np.arange(0, frame.width, block_size), indexing="ij")
+                frame_encoder.get_intra_data_blocks(frame, rows.ravel(), cols.ravel(), block_size)
+        else:
+            for block in frame.get_blocks():
+                frame_encoder.get_intra_data(block)
+                if self.config.VBSEnable:
+                    for sub_block in block.get_sub_blocks():
+                        frame_encoder.get_intra_data(sub_block)
+
+    def process(self):
+        times = {stage: 0.0 for stage in STAGES}
+        pixels = {stage: 0 for stage in STAGES}
+        frame_pixels = self.frames[0].height * self.frames[0].width
+        for seq, (frame, references, packet, reconstruction) in enumerate(zip(self.frames, self.references, self.packets, self.reconstructions)):
+            layout, descriptors, quantized = self.get_packet_residuals(packet)
+            qps = [qp for _, _, _, qp in layout]
+            is_sub_blocks = [is_sub_block for _, _, is_sub_block, _ in layout]
+            if self.config.RCflag > 1:
+                # the first pass searches every frame, I frames of the second pass included
+                times["motion_estimation"] += get_best_time(
+                    lambda: self.run_motion_estimation(frame, self.first_pass_references[seq], self.first_pass_config), self.repeat
+                )
+            if self.coder.is_p_frame():
+                times["motion_estimation"] += get_best_time(
+                    lambda: self.run_motion_estimation(frame, references, self.config, self.seed_tables[seq]), self.repeat
+                )
+            if self.config.RCflag > 1 or self.coder.is_p_frame():
+                pixels["motion_estimation"] += frame_pixels
+            if not self.coder.is_p_frame():
+                times["intra_prediction"] += get_best_time(lambda: self.run_intra_prediction(frame, reconstruction), self.repeat)
+                pixels["intra_prediction"] += frame_pixels
+            residuals = self.coder.decompress_residuals(packet[0], qps, is_sub_blocks)
+            times["transform_quant"] += get_best_time(lambda: self.coder.quantize_residuals(residuals, qps, is_sub_blocks), self.repeat)
+            times["entropy_coding"] += get_best_time(
+                lambda: (self.coder.entrophy_code_residuals(quantized, is_sub_blocks), self.coder.compress_descriptors(descriptors)),
+                self.repeat,
+            )
+            times["reconstruction"] += get_best_time(lambda: self.coder.decompress_residuals(packet[0], qps, is_sub_blocks), self.repeat)
+            for stage in ("transform_quant", "entropy_coding", "reconstruction"):
+                pixels[stage] += frame_pixels
+        # rate control 3 streams are not decodable
+        if self.config.RCflag != 3:
+            def decode():
+                decoder = VideoDecoder(self.height, self.width, copy.deepcopy(self.config))
+                for packet in self.packets:
+                    decoder.process(packet)
+                decoder.close()
+            times["decoding"] = get_best_time(decode, self.repeat)
+            pixels["decoding"] = frame_pixels * len(self.packets)
+        stages = {
+            stage: {"seconds": times[stage], "mpixels_per_second": pixels[stage] / times[stage] / 1e6}
+            for stage in STAGES if pixels[stage]
+        }
+        stages["encoding"] = {
+            "seconds": self.encode_time,
+            "mpixels_per_second": frame_pixels * len(self.frames) / self.encode_time / 1e6,
+        }
+        return stages
+
+
+def run(output_path, video_names, frame_count, repeat, full):
+    results = {"frame_count": frame_count, "repeat": repeat, "results": dict()}
+    for video_name in video_names:
+        for point in get_matrix(full):
+            name = f"{video_name}:{get_point_name(point)}"
+            results["results"][name] = StageBenchmark(video_name, point, frame_count, repeat).process()
+            print(name, " ".join(f"{stage}={result['seconds']:.3f}s" for stage, result in results["results"][name].items()), flush=True)
+            # written after every point so that an interrupted run keeps what it measured
+            with open(output_path, "w") as file:
+                json.dump(results, file, indent=1)
+
+
+def compare(baseline_path, results_path, threshold):
+    # a stage regresses when its throughput drops by more than threshold, returns the regressions
+    with open(baseline_path) as file:
+        baseline = json.load(file)["results"]
+    with open(results_path) as file:
+        results = json.load(file)["results"]
+    regressions = []
+    for name in sorted(set(baseline) & set(results)):
+        for stage in sorted(set(baseline[name]) & set(results[name])):
+            before = baseline[name][stage]["mpixels_per_second"]
+            after = results[name][stage]["mpixels_per_second"]
+            change = after / before - 1
+            flag = ""
+            if change < -threshold:
+                flag = "REGRESSION"
+                regressions.append((name, stage, change))
+            elif change > threshold:
+                flag = "faster"
+            print(f"{name} {stage}: {before:.3f} -> {after:.3f} Mpx/s ({change:+.1%}) {flag}")
+    print(f"{len(regressions)} regressions beyond {threshold:.0%}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PixelPerfect per-stage benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run")
+    run_parser.add_argument("output")
+    run_parser.add_argument("--videos", nargs="+", default=list(VIDEOS), choices=list(VIDEOS))
+    run_parser.add_argument("--frames", type=int, default=5)
+    run_parser.add_argument("--repeat", type=int, default=3)
+    run_parser.add_argument("--full", action="store_true", help="every combination of the matrix")
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("results")
+    compare_parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args.output, args.videos, args.frames, args.repeat, args.full)
+    else:
+        sys.exit(1 if compare(args.baseline, args.results, args.threshold) else 0)
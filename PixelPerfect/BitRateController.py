@@ -5,12 +5,17 @@ import bisect
 class BitRateController:
     def __init__(self, height: int, width: int, config: CodecConfig) -> None:        
         self.config = config
+        # bits of the U and V planes of the last I and P frames, coded after luma with its qps, the next
+        # frame of the same type holds them back from the budget of its luma rows, across GOPs, which
+        # ParallelVideoEncoder.has_independent_gops accounts for
+        self.chroma_bit_counts = {True: 0, False: 0}
         if self.config.RCflag == 1:
             self.budget_per_frame = int(self.config.targetBR * 1024 * (self.config.total_frames / self.config.fps)/self.config.total_frames)
             padded_height, _ = YuvFrame.get_padded_size(height, width, self.config.block_size)
             self.left_budget = self.budget_per_frame
             self.block_rows_per_frame = padded_height // self.config.block_size
             self.coded_rows = 0
+            self.last_row = self.block_rows_per_frame
             self.i_frame_bit_count_sorted = [(int(bc), int(qp)) for qp, bc in self.config.RCTable['I'].items()]
             self.p_frame_bit_count_sorted = [(int(bc), int(qp)) for qp, bc in self.config.RCTable['P'].items()]
             self.p_frame_bit_count_sorted.sort()
@@ -36,6 +41,7 @@ class BitRateController:
             self.block_rows_per_frame = padded_height // self.config.block_size
             self.block_per_row = padded_width//self.config.block_size
             self.coded_rows = 0
+            self.last_row = self.block_rows_per_frame
             self.i_frame_bit_count = [(int(bc), int(qp)) for qp, bc in self.config.RCTable['I'].items()]
             self.p_frame_bit_count = [(int(bc), int(qp)) for qp, bc in self.config.RCTable['P'].items()]
             self.i_frame_bit_count_sorted = self.i_frame_bit_count[:]
@@ -48,16 +54,37 @@ class BitRateController:
             return
         self.left_budget -= bit_count
 
+    def use_chroma_bit_count(self, bit_count: int, is_i_frame):
+        if self.config.RCflag == 0:
+            return
+        self.chroma_bit_counts[is_i_frame] = bit_count
+
+    def get_luma_budget(self, is_i_frame) -> int:
+        return max(self.budget_per_frame - self.chroma_bit_counts[is_i_frame], 0)
+
     def update_used_rows(self):
         if self.config.RCflag == 0:
             return
         self.coded_rows+=1
 
-    def refresh_frame(self):
+    def refresh_frame(self, is_i_frame):
         if self.config.RCflag == 0:
             return
-        self.left_budget = self.budget_per_frame
+        self.left_budget = self.get_luma_budget(is_i_frame)
         self.coded_rows = 0
+        self.last_row = self.block_rows_per_frame
+
+    def refresh_slice(self, first_row, stop_row):
+        # a slice is given the share of the frame budget of its rows and spends it on its own
+        if self.config.RCflag == 0:
+            return
+        budget = self.get_luma_budget(False)
+        if self.config.RCflag == 1:
+            self.left_budget = budget * (stop_row - first_row) // self.block_rows_per_frame
+        else:
+            self.left_budget = int(budget * sum(self.per_row_ratio[first_row:stop_row]) / sum(self.per_row_ratio))
+        self.coded_rows = first_row
+        self.last_row = stop_row
 
     def update_itable(self, qp, bit_count):
         factor = bit_count / self.i_frame_bit_count[qp][0] / self.block_rows_per_frame
@@ -76,9 +103,9 @@ class BitRateController:
         self.per_row_ratio = per_row_bit
     def _get_budget_per_block_row(self) -> int:
         if self.config.RCflag == 1:
-            return int(self.left_budget // (self.block_rows_per_frame - self.coded_rows) )
+            return int(self.left_budget // (self.last_row - self.coded_rows) )
         if self.config.RCflag >1:
-            return int(self.left_budget * self.per_row_ratio[self.coded_rows] / sum(self.per_row_ratio[self.coded_rows:]))
+            return int(self.left_budget * self.per_row_ratio[self.coded_rows] / sum(self.per_row_ratio[self.coded_rows:self.last_row]))
     
     def _find_closest_qp(self, budget: int, is_i_frame: int) -> int:
         bit_count = self.i_frame_bit_count_sorted if is_i_frame else self.p_frame_bit_count_sorted
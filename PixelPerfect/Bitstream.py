@@ -0,0 +1,254 @@
+"""
+File layout, all integers are little endian:
+
+header:  magic "PPEV", version u8, height u16, width u16, block_size u8, i_Period i32, qp u8,
+         nRefFrames u8, flags u8 (VBSEnable, FMEEnable, do_entropy, ChromaEnable), RCflag u8,
+         SliceRows u16 (block rows per P frame slice, 0 for a single slice)
+packet:  frame type u8 (0 = I, 1 = P), frame_seq u32, qp row count u16, one qp u8 per row,
+         descriptor count u32, residual count u32, then the luma payload and, with
+         ChromaEnable, the U and V payloads
+payload: bit length u32, then the Exp-Golomb coded RLE sequences of the descriptors (luma only)
+         and of every residual, back to back and padded to a byte once
+index:   frame count u32, then offset u64 and frame type u8 of every packet
+trailer: index offset u64, magic "PPIX"
+
+An RLE sequence ends once it covers its length, so the payloads need no lengths: the
+descriptors give the block size of every residual. Residuals and descriptors are always stored
+entropy coded, with do_entropy off the reader turns them back into the arrays and lists
+VideoDecoder expects.
+"""
+import struct
+import numpy as np
+from PixelPerfect.CodecConfig import CodecConfig
+from PixelPerfect.Coder import Coder
+from PixelPerfect.Encoder import VideoEncoder
+from PixelPerfect.Decoder import VideoDecoder
+from PixelPerfect.ExpGolomb import ExpGolombBuffer
+from PixelPerfect import ExpGolomb
+
+MAGIC = b"PPEV"
+INDEX_MAGIC = b"PPIX"
+VERSION = 3
+HEADER_FORMAT = "<4sBHHBiBBBBH"
+PACKET_FORMAT = "<BIH"
+COUNTS_FORMAT = "<II"
+PAYLOAD_FORMAT = "<I"
+INDEX_ENTRY_FORMAT = "<QB"
+TRAILER_FORMAT = "<Q4s"
+I_FRAME, P_FRAME = 0, 1
+
+
+def get_descriptors_per_residual(config: CodecConfig, is_p_frame: bool):
+    if is_p_frame:
+        return 4 if config.VBSEnable else 3
+    return 2 if config.VBSEnable else 1
+
+
+def get_RLE_end(symbols, start, length):
+    # end of the RLE sequence starting at start that decodes to length values
+    index, count = start, 0
+    while True:
+        symbol = symbols[index]
+        index += 1
+        if symbol < 0:
+            index -= symbol
+            count -= symbol
+        elif symbol == 0:
+            # the remaining values are zeros
+            count = length
+        else:
+            count += symbol
+        if count >= length:
+            return index
+
+
+class BitstreamWriter:
+    def __init__(self, path, encoder: VideoEncoder) -> None:
+        self.encoder = encoder
+        self.config = encoder.config
+        self.file = open(path, "wb")
+        self.index = []
+        flags = self.config.VBSEnable | self.config.FMEEnable << 1 | self.config.do_entropy << 2 | self.config.ChromaEnable << 3
+        self.file.write(struct.pack(
+            HEADER_FORMAT, MAGIC, VERSION, encoder.height, encoder.width, self.config.block_size,
+            self.config.i_Period, self.config.qp, self.config.nRefFrames, flags, self.config.RCflag,
+            self.config.SliceRows,
+        ))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, compressed_data):
+        compressed_residual, compressed_descriptors, qp_list, frame_seq = compressed_data[:4]
+        is_p_frame = self.encoder.is_p_frame(frame_seq)
+        frame_type = P_FRAME if is_p_frame else I_FRAME
+        self.index.append((self.file.tell(), frame_type))
+        self.file.write(struct.pack(PACKET_FORMAT, frame_type, frame_seq, len(qp_list)))
+        self.file.write(bytes(qp_list))
+        # RLE_coding drops trailing zero descriptors, the count brings them back
+        descriptor_count = get_descriptors_per_residual(self.config, is_p_frame) * len(compressed_residual)
+        self.file.write(struct.pack(COUNTS_FORMAT, descriptor_count, len(compressed_residual)))
+        if self.config.do_entropy:
+            self.write_payload(ExpGolomb.concatenate([compressed_descriptors] + compressed_residual))
+        else:
+            self.write_payload(self.entrophy_code(compressed_residual, compressed_descriptors))
+        if self.config.ChromaEnable:
+            for compressed_plane in compressed_data[4]:
+                if self.config.do_entropy:
+                    self.write_payload(ExpGolomb.concatenate(compressed_plane))
+                else:
+                    self.write_payload(self.entrophy_code(compressed_plane))
+
+    def entrophy_code(self, quantized, descriptors=None):
+        # a single Exp-Golomb pass over the RLE sequences of the whole payload
+        symbols = self.encoder.RLE_coding(descriptors) if descriptors is not None else []
+        for residual in quantized:
+            symbols += self.encoder.RLE_coding(self.encoder.diagonalize_matrix(residual))
+        return ExpGolomb.encode(symbols)
+
+    def write_payload(self, payload: ExpGolombBuffer):
+        self.file.write(struct.pack(PAYLOAD_FORMAT, payload.length))
+        self.file.write(payload.data)
+
+    def close(self):
+        if self.file.closed:
+            return
+        index_offset = self.file.tell()
+        self.file.write(struct.pack("<I", len(self.index)))
+        for offset, frame_type in self.index:
+            self.file.write(struct.pack(INDEX_ENTRY_FORMAT, offset, frame_type))
+        self.file.write(struct.pack(TRAILER_FORMAT, index_offset, INDEX_MAGIC))
+        self.file.close()
+
+
+class BitstreamReader:
+    def __init__(self, path) -> None:
+        self.file = open(path, "rb")
+        header = self.read_struct(HEADER_FORMAT)
+        magic, version, self.height, self.width, block_size, i_Period, qp, nRefFrames, flags, self.RCflag, slice_rows = header
+        if magic != MAGIC or version != VERSION:
+            raise Exception(f"Error! {path} is not a PixelPerfect bitstream")
+        # qp rows and frame_seq travel with every packet, the decoder needs no rate control setup
+        self.config = CodecConfig(
+            block_size=block_size,
+            i_Period=i_Period,
+            qp=qp,
+            nRefFrames=nRefFrames,
+            VBSEnable=bool(flags & 1),
+            FMEEnable=bool(flags & 2),
+            do_entropy=bool(flags & 4),
+            ChromaEnable=bool(flags & 8),
+            SliceRows=slice_rows,
+        )
+        self.coder = Coder(self.height, self.width, self.config)
+        if self.config.ChromaEnable:
+            self.chroma_coder = Coder(self.height // 2, self.width // 2, self.config.get_chroma_config())
+        self.file.seek(-struct.calcsize(TRAILER_FORMAT), 2)
+        index_offset, index_magic = self.read_struct(TRAILER_FORMAT)
+        if index_magic != INDEX_MAGIC:
+            raise Exception(f"Error! {path} has no frame index, was the writer closed?")
+        self.file.seek(index_offset)
+        frame_count, = self.read_struct("<I")
+        self.index = [self.read_struct(INDEX_ENTRY_FORMAT) for _ in range(frame_count)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        for frame_index in range(len(self)):
+            yield self.read(frame_index)
+
+    def read_struct(self, format):
+        return struct.unpack(format, self.file.read(struct.calcsize(format)))
+
+    def is_p_frame(self, frame_index: int) -> bool:
+        return self.index[frame_index][1] == P_FRAME
+
+    def get_frame_seq(self, frame_index: int) -> int:
+        # only the packet header is read
+        self.file.seek(self.index[frame_index][0])
+        return self.read_struct(PACKET_FORMAT)[1]
+
+    def read(self, frame_index: int):
+        # frame_index is the position in the file, returns the tuple VideoEncoder.process produced
+        self.file.seek(self.index[frame_index][0])
+        frame_type, frame_seq, row_count = self.read_struct(PACKET_FORMAT)
+        qp_list = list(self.file.read(row_count))
+        descriptor_count, residual_count = self.read_struct(COUNTS_FORMAT)
+        payload, symbols = self.read_payload()
+        descriptors_end = get_RLE_end(symbols, 0, descriptor_count)
+        descriptors = self.coder.RLE_decoding(symbols[:descriptors_end], descriptor_count)
+        # the sub-block flag follows the mv of a P block and the mode of an I block
+        descriptors_per_residual = get_descriptors_per_residual(self.config, frame_type == P_FRAME)
+        sub_block_flag_index = 2 if frame_type == P_FRAME else 1
+        is_sub_blocks = [
+            self.config.VBSEnable and descriptors[seq * descriptors_per_residual + sub_block_flag_index] == 1
+            for seq in range(residual_count)
+        ]
+        if self.config.do_entropy:
+            compressed_descriptors, *compressed_residual = self.split_payload(
+                payload, symbols, self.coder, is_sub_blocks, descriptors_end
+            )
+        else:
+            compressed_descriptors = descriptors
+            compressed_residual = self.to_quantized_residuals(symbols, self.coder, is_sub_blocks, descriptors_end)
+        compressed_data = (compressed_residual, compressed_descriptors, qp_list, frame_seq)
+        if self.config.ChromaEnable:
+            compressed_chroma = []
+            for _ in range(2):
+                payload, symbols = self.read_payload()
+                if self.config.do_entropy:
+                    compressed_chroma.append(self.split_payload(payload, symbols, self.chroma_coder, is_sub_blocks))
+                else:
+                    compressed_chroma.append(self.to_quantized_residuals(symbols, self.chroma_coder, is_sub_blocks))
+            compressed_data += (compressed_chroma,)
+        return compressed_data
+
+    def read_payload(self):
+        length, = self.read_struct(PAYLOAD_FORMAT)
+        payload = ExpGolombBuffer(self.file.read((length + 7) // 8), length)
+        return payload, ExpGolomb.decode(payload).tolist()
+
+    def get_residual_bounds(self, symbols, coder: Coder, is_sub_blocks, start):
+        # symbol range of every residual, the payload must end with the last one
+        bounds = []
+        for is_sub_block in is_sub_blocks:
+            block_size = coder.config.sub_block_size if is_sub_block else coder.config.block_size
+            end = get_RLE_end(symbols, start, block_size * block_size)
+            bounds.append((start, end))
+            start = end
+        if start != len(symbols):
+            raise Exception("Error! Payload does not match its residual count")
+        return bounds
+
+    def split_payload(self, payload: ExpGolombBuffer, symbols, coder: Coder, is_sub_blocks, descriptors_end=None):
+        # Exp-Golomb buffers of the descriptors (when the payload holds them) and of every residual
+        start = descriptors_end or 0
+        ends = [0, start] if descriptors_end is not None else [0]
+        ends += [end for _, end in self.get_residual_bounds(symbols, coder, is_sub_blocks, start)]
+        bit_offsets = np.concatenate([[0], np.cumsum(ExpGolomb.get_symbol_lengths(symbols))])[ends]
+        return ExpGolomb.split(payload, np.diff(bit_offsets).tolist())
+
+    def to_quantized_residuals(self, symbols, coder: Coder, is_sub_blocks, start=0):
+        residuals = []
+        bounds = self.get_residual_bounds(symbols, coder, is_sub_blocks, start)
+        for (residual_start, residual_end), is_sub_block in zip(bounds, is_sub_blocks):
+            block_size = coder.config.sub_block_size if is_sub_block else coder.config.block_size
+            residual = coder.RLE_decoding(symbols[residual_start:residual_end], block_size * block_size)
+            residuals.append(coder.dediagonalize_sequence(residual, block_size))
+        return residuals
+
+    def create_decoder(self) -> VideoDecoder:
+        return VideoDecoder(self.height, self.width, self.config)
+
+    def close(self):
+        self.file.close()
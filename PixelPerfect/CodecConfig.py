@@ -1,3 +1,6 @@
+import copy
+import inspect
+
 class CodecConfig:
     def __init__(
         self,
@@ -17,6 +20,8 @@ class CodecConfig:
         DisplayMvAndMode: bool = False,
         DisplayRefFrames: bool = False,
         FastME_LIMIT: int = -1,
+        FastME_METHOD: str = "cross",
+        FastME_SUB_BLOCK_SEARCH: bool = True,
         RCTable: dict = dict(),
         RCflag: int = 0,
         targetBR: float = 0,
@@ -24,6 +29,13 @@ class CodecConfig:
         total_frames: int = 0,
         filename = '',
         is_firstpass = False,
+        ChromaEnable: bool = False,
+        SliceRows: int = 0,
+        SliceWorkers: int = 0,
+        PyramidME: bool = False,
+        PyramidLevels: int = 2,
+        FMEFullSearch: bool = False,
+        RCSecondPassSearch: bool = False,
     ) -> None:
         self.block_size = block_size
         self.sub_block_size = block_size // 2
@@ -42,10 +54,51 @@ class CodecConfig:
         self.DisplayMvAndMode = DisplayMvAndMode
         self.DisplayRefFrames = DisplayRefFrames
         self.FastME_LIMIT = FastME_LIMIT
+        # "cross" steps from the mv predictor, "epzs" starts from the best neighbour mv and refines it with diamonds
+        self.FastME_METHOD = FastME_METHOD
+        # with VBSEnable, every sub-block is searched on its own, unless turned off for the sub-blocks
+        # to take the best candidate scored by the search of their block, which changes the streams
+        self.FastME_SUB_BLOCK_SEARCH = FastME_SUB_BLOCK_SEARCH
         self.RCTable = RCTable
         self.RCflag = RCflag
         self.targetBR = targetBR
         self.fps = fps
         self.total_frames = total_frames
         self.filename = filename
-        self.is_firstpass = is_firstpass
\ No newline at end of file
+        self.is_firstpass = is_firstpass
+        # U and V are coded with the luma decisions, rate control holds their bits back from the luma budget
+        self.ChromaEnable = ChromaEnable
+        # P frames are cut into slices of SliceRows block rows, coded on SliceWorkers processes
+        self.SliceRows = SliceRows
+        self.SliceWorkers = SliceWorkers
+        # motion is searched on frames downsampled PyramidLevels times, then refined level by level
+        self.PyramidME = PyramidME
+        self.PyramidLevels = PyramidLevels
+        # with FMEEnable, search every half-pel position of the window instead of the integer ones
+        # followed by the eight half-pel neighbours of the best
+        self.FMEFullSearch = FMEFullSearch
+        # with RCflag > 1, search the second pass again instead of refining the mvs of the first pass
+        self.RCSecondPassSearch = RCSecondPassSearch
+
+    def get_changed_config(self, **changes):
+        # a new config built from the arguments of this one, the derived fields follow the changes
+        names = [name for name in inspect.signature(CodecConfig.__init__).parameters if name != "self"]
+        for name in changes:
+            if name not in names:
+                raise Exception(f"Error! {name} is not a CodecConfig argument")
+        arguments = {name: copy.deepcopy(getattr(self, name)) for name in names}
+        return CodecConfig(**{**arguments, **changes})
+
+    def get_chroma_config(self):
+        # 4:2:0 planes keep the luma block grid at half the size
+        config = copy.copy(self)
+        config.block_size = self.block_size // 2
+        config.sub_block_size = self.sub_block_size // 2
+        # halved luma mvs land on half-pel positions
+        config.FMEEnable = True
+        config.RCflag = 0
+        config.ChromaEnable = False
+        config.DisplayBlocks = False
+        config.DisplayMvAndMode = False
+        config.DisplayRefFrames = False
+        return config
@@ -2,11 +2,16 @@ import numpy as np
 from PixelPerfect.Yuv import YuvFrame, ReferenceFrame
 from PixelPerfect.ResidualProcessor import ResidualProcessor
 from PixelPerfect.CodecConfig import CodecConfig
-from bitstring import BitArray, BitStream
-from math import log2, floor
+from PixelPerfect import ExpGolomb
+from PixelPerfect.Stats import CodecStats, timed
+from concurrent.futures import ProcessPoolExecutor
 from typing import Deque
+from functools import cache
 
 class Coder:
+    # CodecStats shared by the coders of a VideoCoder once enable_stats is called
+    stats = None
+
     def __init__(self, height, width, config: CodecConfig) -> None:
         if config.RCflag == 1:
             if config.targetBR == 0:
@@ -35,6 +40,27 @@ class Coder:
                 "Error! FastME_LIMIT must be set when FastME is enabled"
             )
         
+        if config.FastME_METHOD not in ("cross", "epzs"):
+            raise Exception(
+                f"Error! Unknown FastME_METHOD {config.FastME_METHOD}"
+            )
+
+        if config.PyramidME and config.FastME:
+            raise Exception(
+                "Error! PyramidME and FastME can not be enabled together"
+            )
+
+        if config.PyramidME and config.block_size % (2 ** config.PyramidLevels) != 0:
+            raise Exception(
+                "Error! PyramidME needs a block_size divisible by 2 ** PyramidLevels"
+            )
+
+        if config.SliceRows > 0 and width % config.block_size != 0:
+            # qp rows follow the unpadded width, a slice would start in the middle of one
+            raise Exception(
+                "Error! SliceRows needs a width that is a multiple of block_size"
+            )
+
         config.need_display = config.DisplayBlocks or config.DisplayMvAndMode or config.DisplayRefFrames
             
         self.config = config
@@ -46,7 +72,7 @@ class Coder:
         self.blocks_per_row = width // config.block_size
         
     # region Decoding
-    def RLE_decoding(self, sequence, block_size):
+    def RLE_decoding(self, sequence, length):
         decoded = []
         index = 0
         while index < len(sequence):
@@ -56,38 +82,22 @@ class Coder:
             else:
                 decoded.extend([0] * sequence[index])
             index += 1
-        decoded.extend([0] * (pow(block_size, 2) - len(decoded)))
+        decoded.extend([0] * (length - len(decoded)))
         return decoded
 
     def dediagonalize_sequence(self, sequence, block_size):
-        # put it back to 2d array
-        quantized_data = [
-            [0 for i in range(block_size)]
-            for j in range(block_size)
-        ]
-        i = 0
-        for diagonal_length in range(1, block_size + 1):
-            for j in range(diagonal_length):
-                quantized_data[j][diagonal_length - j - 1] = sequence[i]
-                i += 1
-        for diagonal_length in range(block_size - 1, 0, -1):
-            for j in range(diagonal_length):
-                quantized_data[block_size - diagonal_length + j][
-                    -1 * j - 1
-                ] = sequence[i]
-                i += 1
-        # retransform the data:
-        quantized_data = np.array(quantized_data)
-        return quantized_data
+        # put it back to 2d array, works on a single sequence or a batch of them
+        sequence = np.asarray(sequence)
+        quantized_data = sequence[..., Coder.get_inverse_scan_order(block_size)]
+        return quantized_data.reshape(*sequence.shape[:-1], block_size, block_size)
 
+    @timed("entropy_decoding")
     def Entrophy_decoding(self, data, block_size):
-        data.pos = 0
-        RLE_coded = []
-        while data.pos != len(data):
-            RLE_coded.append(data.read("se"))
-        RLE_decoded = self.RLE_decoding(RLE_coded, block_size)
+        RLE_coded = ExpGolomb.decode(data).tolist()
+        RLE_decoded = self.RLE_decoding(RLE_coded, pow(block_size, 2))
         return RLE_decoded
 
+    @timed("reconstruction")
     def decompress_residual(self, residual: np.ndarray, qp: int, is_sub_block: bool):
         if self.config.do_entropy:
             block_size = self.config.sub_block_size if is_sub_block else self.config.block_size
@@ -97,9 +107,43 @@ class Coder:
         residual = self.residual_processor.de_dct(residual)
         return residual
 
-    def decompress_descriptors(self, descriptors):
+    @timed("reconstruction")
+    def decompress_residuals(self, residuals, qps, is_sub_blocks):
+        # residuals of the same block size are de-quantized and transformed back as one batch
+        decompressed = [None] * len(residuals)
+        for is_sub_block in (False, True):
+            seqs = [seq for seq in range(len(residuals)) if bool(is_sub_blocks[seq]) == is_sub_block]
+            if not seqs:
+                continue
+            block_size = self.config.sub_block_size if is_sub_block else self.config.block_size
+            if self.config.do_entropy:
+                batch = [self.Entrophy_decoding(residuals[seq], block_size) for seq in seqs]
+                batch = self.dediagonalize_sequence(batch, block_size)
+            else:
+                batch = np.stack([residuals[seq] for seq in seqs])
+            batch = self.residual_processor.batch_de_quantization(
+                batch, [qps[seq] for seq in seqs], [is_sub_block] * len(seqs)
+            )
+            batch = self.residual_processor.batch_de_dct(batch)
+            for seq, residual in zip(seqs, batch):
+                decompressed[seq] = residual
+        return decompressed
+
+    @timed("reconstruction")
+    def dequantize_residuals(self, quantized, qps, is_sub_blocks):
+        # quantized residuals of a batch back to residuals, entropy decoding aside
+        residuals = self.residual_processor.batch_de_quantization(np.stack(quantized), qps, is_sub_blocks)
+        return self.residual_processor.batch_de_dct(residuals)
+
+    def get_block_positions(self, layout, seqs):
+        positions = np.array([self.get_position_by_seq(layout[seq][0], layout[seq][1]) for seq in seqs], dtype=np.int64)
+        return positions[:, 0], positions[:, 1]
+
+    @timed("entropy_decoding")
+    def decompress_descriptors(self, descriptors, count):
         if self.config.do_entropy:
-            descriptors = self.Entrophy_decoding(descriptors)
+            # trailing zeros are not coded, count brings them back
+            descriptors = self.RLE_decoding(ExpGolomb.decode(descriptors).tolist(), count)
         return descriptors
 
     def get_position_by_seq(self, block_seq, sub_block_seq):
@@ -112,15 +156,34 @@ class Coder:
     # endregion
 
     # region Encoding
+    @timed("entropy_coding")
     def cal_entrophy_bitcount(self, sequence):
-        sequence = self.RLE_coding(sequence)
-        length = 0
-        for v in sequence:
-            if v == 0:
-                length += 1
-            else:
-                length += 3 + 2 * floor(log2(abs(v)))
-        return length
+        if isinstance(sequence, np.ndarray):
+            return int(self.cal_entrophy_bitcounts(sequence[np.newaxis])[0])
+        # short python lists such as descriptors are cheaper to count one symbol at a time
+        return sum(ExpGolomb.get_code_length(v) for v in self.RLE_coding(sequence))
+
+    def cal_entrophy_bitcounts(self, sequences: np.ndarray) -> np.ndarray:
+        # bit count of every row once RLE_coding and entrophy_coding are applied, without building either
+        count, length = sequences.shape
+        is_non_zero = sequences != 0
+        bitcounts = (ExpGolomb.get_symbol_lengths(sequences) * is_non_zero).sum(axis=1)
+        # each run starts where the zero flag flips, the row end closes the last one
+        flags = np.full((count, length + 2), -1, dtype=np.int8)
+        flags[:, 1:-1] = is_non_zero
+        rows, starts = np.nonzero(flags[:, 1:] != flags[:, :-1])
+        is_run = starts[:-1] < length
+        run_rows, run_starts = rows[:-1][is_run], starts[:-1][is_run]
+        run_lengths = (starts[1:] - starts[:-1])[is_run]
+        is_non_zero_run = is_non_zero[run_rows, run_starts]
+        # non zero runs store -length, trailing zeros a single 0 unless the whole row is zero
+        is_trailing = (run_starts + run_lengths == length) & is_non_zero.any(axis=1)[run_rows]
+        run_symbols = np.where(is_non_zero_run, -run_lengths, np.where(is_trailing, 0, run_lengths))
+        bitcounts += np.bincount(run_rows, weights=ExpGolomb.get_symbol_lengths(run_symbols), minlength=count).astype(np.int64)
+        if length == 0:
+            # RLE_coding still writes a single 0
+            bitcounts += 1
+        return bitcounts
 
     def RLE_coding(self, data):
         sequence = []
@@ -152,39 +215,85 @@ class Coder:
         sequence.reverse()
         return sequence
 
+    @staticmethod
+    @cache
+    def get_scan_order(block_size):
+        # anti-diagonals from the top left corner, each one from top to bottom
+        rows, cols = np.indices((block_size, block_size)).reshape(2, -1)
+        return np.lexsort((rows, rows + cols))
+
+    @staticmethod
+    @cache
+    def get_inverse_scan_order(block_size):
+        return np.argsort(Coder.get_scan_order(block_size))
+
     def diagonalize_matrix(self, data):
-        max_col = data.shape[1]
-        max_row = data.shape[0]
-        fdiag = [[] for _ in range(max_row + max_col - 1)]
-        for y in range(max_col):
-            for x in range(max_row):
-                fdiag[x + y].append(data[y, x])
-        sequence = []
-        for diag in fdiag:
-            sequence.extend(diag)
-        return sequence
+        # works on a single block or a batch of blocks
+        block_size = data.shape[-1]
+        return data.reshape(*data.shape[:-2], block_size * block_size)[..., Coder.get_scan_order(block_size)]
 
     def entrophy_coding(self, sequence):
         sequence = self.RLE_coding(sequence)
-        bit_sequence = BitStream().join([BitArray(se=i) for i in sequence])
-        return bit_sequence
+        return ExpGolomb.encode(sequence)
 
-    def compress_residual(self, residual: np.ndarray, qp: int, is_sub_block: int):
-        bitrate = 0
+    @timed("entropy_coding")
+    def entrophy_code_residual(self, quantized: np.ndarray):
+        if self.config.do_entropy:
+            residual = self.diagonalize_matrix(quantized)
+            residual = self.entrophy_coding(residual)
+            return residual, residual.length
+        return quantized, self.cal_entrophy_bitcount(self.diagonalize_matrix(quantized))
+
+    def cal_residual_bitcounts(self, quantized: np.ndarray) -> np.ndarray:
+        # bit count of a (N, block_size, block_size) stack of quantized residuals
+        return self.cal_entrophy_bitcounts(self.diagonalize_matrix(quantized))
+
+    @timed("transform_quant")
+    def quantize_residual(self, residual: np.ndarray, qp: int, is_sub_block: int):
         if self.config.do_approximated_residual:
             residual = self.residual_processor.approx(residual)
         residual = self.residual_processor.dct_transform(residual)
-        residual = self.residual_processor.quantization(residual, qp, is_sub_block)
+        return self.residual_processor.quantization(residual, qp, is_sub_block)
+
+    def compress_residual(self, residual: np.ndarray, qp: int, is_sub_block: int):
+        return self.entrophy_code_residual(self.quantize_residual(residual, qp, is_sub_block))
+
+    @timed("entropy_coding")
+    def entrophy_code_residuals(self, quantized, is_sub_blocks):
+        # bit counts of quantized residuals of both block sizes are taken one batch per size
         if self.config.do_entropy:
-            residual = self.diagonalize_matrix(residual)
-            residual = self.entrophy_coding(residual)
-            bitrate += residual.length
-        else:
-            bitrate += self.cal_entrophy_bitcount(
-                self.diagonalize_matrix(residual)
-            )
-        return residual, bitrate
+            coded = [self.entrophy_code_residual(residual) for residual in quantized]
+            return [residual for residual, _ in coded], [bitrate for _, bitrate in coded]
+        bitrates = [0] * len(quantized)
+        for is_sub_block in (False, True):
+            seqs = [seq for seq in range(len(quantized)) if bool(is_sub_blocks[seq]) == is_sub_block]
+            if seqs:
+                bitcounts = self.cal_residual_bitcounts(np.stack([quantized[seq] for seq in seqs]))
+                for seq, bitrate in zip(seqs, bitcounts.tolist()):
+                    bitrates[seq] = bitrate
+        return list(quantized), bitrates
+
+    def compress_residuals(self, residuals, qps, is_sub_blocks):
+        return self.entrophy_code_residuals(self.quantize_residuals(residuals, qps, is_sub_blocks), is_sub_blocks)
+
+    @timed("transform_quant")
+    def quantize_residuals(self, residuals, qps, is_sub_blocks):
+        # residuals of the same block size are transformed and quantized as one batch
+        quantized = [None] * len(residuals)
+        for is_sub_block in (False, True):
+            seqs = [seq for seq in range(len(residuals)) if bool(is_sub_blocks[seq]) == is_sub_block]
+            if not seqs:
+                continue
+            batch = np.stack([residuals[seq] for seq in seqs])
+            if self.config.do_approximated_residual:
+                batch = self.residual_processor.approx(batch)
+            batch = self.residual_processor.batch_dct_transform(batch)
+            batch = self.residual_processor.batch_quantization(batch, [qps[seq] for seq in seqs], [is_sub_block] * len(seqs))
+            for seq, residual in zip(seqs, batch):
+                quantized[seq] = residual
+        return quantized
 
+    @timed("entropy_coding")
     def compress_descriptors(self, descriptors):
         bitrate = 0
         if self.config.do_entropy:
@@ -198,18 +307,126 @@ class Coder:
 
 
 class VideoCoder(Coder):
+    # pool of SliceWorkers processes, created with the first frame coded in slices
+    executor = None
+
     def __init__(self, height, width, config: CodecConfig) -> None:
         super().__init__(height, width, config)
         self.frame_seq = 0
         self.previous_frames: Deque[ReferenceFrame] = Deque(maxlen=config.nRefFrames)
-        self.previous_frames.append(ReferenceFrame(config, np.full(shape=(self.height, self.width), fill_value=128, dtype=np.uint8)))
-        
-    def is_p_frame(self):
+        self.previous_frames.append(self.get_initial_reference())
+
+    def __getstate__(self):
+        # the pool stays with the coder that created it
+        state = self.__dict__.copy()
+        state.pop("executor", None)
+        return state
+
+    def get_executor(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.config.SliceWorkers)
+        return self.executor
+
+    def close(self):
+        # stops the slice workers, a coder can still be used after and starts new ones
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def get_slice_references(self):
+        # reference frames for a slice worker, without the planes it can derive again
+        return Deque([frame.get_uncached_copy() for frame in self.previous_frames], maxlen=self.previous_frames.maxlen)
+
+    def enable_stats(self, stream_path=None):
+        # statistics of every frame processed from now on, also written to stream_path as JSON lines
+        self.stats = CodecStats(stream_path)
+
+    def attach_stats(self, *coders):
+        # coders created for a frame report to the statistics of the video coder
+        for coder in coders:
+            coder.stats = self.stats
+
+    def get_initial_reference(self):
+        # the first P frame is predicted from a flat gray frame
+        frame = ReferenceFrame(self.config, np.full(shape=(self.height, self.width), fill_value=128, dtype=np.uint8))
+        if self.config.ChromaEnable:
+            chroma_config = self.config.get_chroma_config()
+            frame.chroma = [
+                ReferenceFrame(chroma_config, np.full(shape=(self.height // 2, self.width // 2), fill_value=128, dtype=np.uint8))
+                for _ in range(2)
+            ]
+        return frame
+
+    def get_residual_layout(self, descriptors, qp_list, residual_count, descriptors_per_residual, sub_block_flag_index):
+        # position, block size and qp of every residual of a frame
+        layout = []
+        block_seq = 0
+        sub_block_seq = 0
+        for seq in range(residual_count):
+            # qp_list holds the qp of every block row, rate control or not
+            if block_seq % self.blocks_per_row == 0:
+                qp = qp_list[block_seq // self.blocks_per_row]
+            is_sub_block = self.config.VBSEnable and descriptors[seq * descriptors_per_residual + sub_block_flag_index] == 1
+            layout.append((block_seq, sub_block_seq, is_sub_block, qp))
+            if is_sub_block:
+                sub_block_seq += 1
+                if sub_block_seq == 4:
+                    sub_block_seq = 0
+                    block_seq += 1
+            else:
+                block_seq += 1
+        return layout
+
+    def get_slices(self):
+        # first and stop block seqs of every P frame slice
+        padded_height, _ = YuvFrame.get_padded_size(self.height, self.width, self.config.block_size)
+        block_rows = padded_height // self.config.block_size
+        slice_rows = self.config.SliceRows if self.config.SliceRows > 0 else block_rows
+        return [
+            (row * self.row_block_num, min(row + slice_rows, block_rows) * self.row_block_num)
+            for row in range(0, block_rows, slice_rows)
+        ]
+
+    def is_slice_start(self, block_seq):
+        return self.config.SliceRows > 0 and block_seq % (self.config.SliceRows * self.row_block_num) == 0
+
+    def get_inter_predictions(self, descriptors, layout, descriptors_per_residual, block_mvs=None):
+        # (frame_seq, row_mv, col_mv) of every residual, mvs are coded as differences within a slice,
+        # or from block_mvs at the start of every block like the second pass of rate control 3
+        predictions = []
+        last_row_mv, last_col_mv = 0, 0
+        for seq, (block_seq, sub_block_seq, _, _) in enumerate(layout):
+            if sub_block_seq == 0 and self.is_slice_start(block_seq):
+                last_row_mv, last_col_mv = 0, 0
+            if sub_block_seq == 0 and block_mvs is not None:
+                last_row_mv, last_col_mv = block_mvs[block_seq]
+            descriptor = descriptors[seq * descriptors_per_residual : (seq + 1) * descriptors_per_residual]
+            if self.config.FMEEnable:
+                row_mv, col_mv = descriptor[0] / 2 + last_row_mv, descriptor[1] / 2 + last_col_mv
+            else:
+                row_mv, col_mv = descriptor[0] + last_row_mv, descriptor[1] + last_col_mv
+            predictions.append((descriptor[-1], row_mv, col_mv))
+            last_row_mv, last_col_mv = row_mv, col_mv
+        return predictions
+
+    def get_block_predictions(self, descriptors, qp_list, residual_count, block_mvs=None):
+        # layout and mvs or intra modes of every residual, as the decoder sees them
+        if self.is_p_frame():
+            descriptors_per_residual = 4 if self.config.VBSEnable else 3
+            layout = self.get_residual_layout(descriptors, qp_list, residual_count, descriptors_per_residual, 2)
+            return layout, self.get_inter_predictions(descriptors, layout, descriptors_per_residual, block_mvs)
+        descriptors_per_residual = 2 if self.config.VBSEnable else 1
+        layout = self.get_residual_layout(descriptors, qp_list, residual_count, descriptors_per_residual, 1)
+        return layout, descriptors[: residual_count * descriptors_per_residual : descriptors_per_residual]
+
+    def is_p_frame(self, frame_seq: int = None):
+        if frame_seq is None:
+            frame_seq = self.frame_seq
         if self.config.i_Period == -1:
             return True
         if self.config.i_Period == 0:
             return False
-        if self.frame_seq % self.config.i_Period == 0:
+        if frame_seq % self.config.i_Period == 0:
             return False
         else:
             return True
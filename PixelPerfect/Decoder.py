@@ -1,23 +1,46 @@
 from PixelPerfect.Yuv import ConstructingFrame, ReferenceFrame
 from PixelPerfect.Coder import Coder, VideoCoder
 from PixelPerfect.CodecConfig import CodecConfig
+from PixelPerfect.Stats import timed
 from typing import Deque
 import numpy as np
 import cv2
 
-class IntraFrameDecoder(Coder):
+class FrameDecoder(Coder):
     def __init__(self, height, width, config: CodecConfig) -> None:
         super().__init__(height, width, config)
         self.frame = ConstructingFrame(self.config, height=height, width=width)
+        self.constructing_frames = [self.frame]
         if self.config.need_display:
             self.display_BW_frame = ConstructingFrame(self.config, height=height, width=width)
+            self.constructing_frames.append(self.display_BW_frame)
             if self.config.DisplayRefFrames:
                 self.display_Color_frame = ConstructingFrame(self.config, height=height, width=width)
+                self.constructing_frames.append(self.display_Color_frame)
+
+    def snapshot(self, block_seq):
+        # state of a block in every frame being built, drawings crossing the block border are not kept
+        row, col = self.get_position_by_seq(block_seq, 0)
+        return [frame.snapshot(row, col, self.config.block_size) for frame in self.constructing_frames]
+
+    def rollback(self, snapshot):
+        for frame, frame_snapshot in zip(self.constructing_frames, snapshot):
+            frame.rollback(frame_snapshot)
+
+
+class IntraFrameDecoder(FrameDecoder):
+    def __init__(self, height, width, config: CodecConfig) -> None:
+        super().__init__(height, width, config)
 
     # this function should be idempotent
     def process(self, block_seq, sub_block_seq, residual, mode, is_sub_block, qp):
-        row, col = self.get_position_by_seq(block_seq, sub_block_seq)
         residual = self.decompress_residual(residual, qp, is_sub_block)
+        self.reconstruct(block_seq, sub_block_seq, residual, mode, is_sub_block)
+
+    # residual has already been decompressed
+    @timed("reconstruction")
+    def reconstruct(self, block_seq, sub_block_seq, residual, mode, is_sub_block):
+        row, col = self.get_position_by_seq(block_seq, sub_block_seq)
         if mode == 0:  # vertical
             ref_block = self.frame.get_vertical_ref_block(row, col, is_sub_block)
         else:  # horizontal
@@ -35,21 +58,70 @@ class IntraFrameDecoder(Coder):
             if self.config.DisplayMvAndMode:
                 self.display_BW_frame.draw_mode(row, col, block_size, mode)
 
-class InterFrameDecoder(Coder):
+    @timed("intra_prediction")
+    def predict_blocks(self, rows, cols, block_size):
+        # vertical and horizontal predictions of a batch, the rows above and columns left must be reconstructed
+        offsets = np.arange(block_size)
+        above = self.frame.data[np.maximum(rows - 1, 0)[:, np.newaxis], cols[:, np.newaxis] + offsets]
+        left = self.frame.data[rows[:, np.newaxis] + offsets, np.maximum(cols - 1, 0)[:, np.newaxis]]
+        above[rows == 0] = 0
+        left[cols == 0] = 0
+        vertical = np.repeat(above[:, np.newaxis, :], block_size, axis=1)
+        horizontal = np.repeat(left[:, :, np.newaxis], block_size, axis=2)
+        return vertical, horizontal
+
+    def get_waves(self, layout):
+        """
+        Groups residuals into wavefronts. A residual only reads the row above and the column left
+        of it, so it can be reconstructed one wave after the residuals covering them, and the
+        residuals of a wave do not depend on each other.
+        """
+        cell_size = self.config.sub_block_size
+        # finished wave of every sub-block sized cell, shifted by one so the frame edges read -1
+        done = np.full((self.frame.height // cell_size + 1, self.frame.width // cell_size + 1), -1)
+        waves = []
+        for seq, (block_seq, sub_block_seq, is_sub_block, _) in enumerate(layout):
+            row, col = self.get_position_by_seq(block_seq, sub_block_seq)
+            row, col = row // cell_size + 1, col // cell_size + 1
+            size = 1 if is_sub_block else self.config.block_size // cell_size
+            wave = max(done[row - 1, col : col + size].max(), done[row : row + size, col - 1].max()) + 1
+            done[row : row + size, col : col + size] = wave
+            if wave == len(waves):
+                waves.append([])
+            waves[wave].append(seq)
+        return waves
+
+    @timed("reconstruction")
+    def reconstruct_wavefront(self, layout, residuals, modes):
+        # same frame as reconstructing residual by residual, every wave is one batch per block size
+        modes = np.asarray(modes)
+        for wave in self.get_waves(layout):
+            for is_sub_block in (False, True):
+                seqs = [seq for seq in wave if bool(layout[seq][2]) == is_sub_block]
+                if not seqs:
+                    continue
+                block_size = self.config.sub_block_size if is_sub_block else self.config.block_size
+                rows, cols = self.get_block_positions(layout, seqs)
+                vertical, horizontal = self.predict_blocks(rows, cols, block_size)
+                predictions = np.where(modes[seqs][:, np.newaxis, np.newaxis] == 0, vertical, horizontal)
+                self.frame.put_blocks(rows, cols, predictions + np.stack([residuals[seq] for seq in seqs]))
+
+
+class InterFrameDecoder(FrameDecoder):
     def __init__(self, height, width, previous_frames: Deque[ReferenceFrame], config: CodecConfig) -> None:
         super().__init__(height, width, config)
         self.previous_frames = previous_frames
-        self.frame = ConstructingFrame(self.config, height=height, width=width)
-        if self.config.need_display:
-            self.display_BW_frame = ConstructingFrame(self.config, height=height, width=width)
-            if self.config.DisplayRefFrames:
-                self.display_Color_frame = ConstructingFrame(self.config, height=height, width=width)
-            
+
     # this function should be idempotent
     def process(self, frame_seq, block_seq, sub_block_seq, residual, row_mv, col_mv, is_sub_block: bool, qp: int):
+        residual = self.decompress_residual(residual, qp, is_sub_block)
+        self.reconstruct(frame_seq, block_seq, sub_block_seq, residual, row_mv, col_mv, is_sub_block)
+
+    # residual has already been decompressed
+    @timed("reconstruction")
+    def reconstruct(self, frame_seq, block_seq, sub_block_seq, residual, row_mv, col_mv, is_sub_block: bool):
         ref_frame = self.previous_frames[frame_seq]
         row, col = self.get_position_by_seq(block_seq, sub_block_seq)
-        residual = self.decompress_residual(residual, qp, is_sub_block)
         if is_sub_block:
             block_size = self.config.sub_block_size
         else:
@@ -66,53 +138,128 @@ class InterFrameDecoder(Coder):
             if self.config.DisplayBlocks:
                 self.display_BW_frame.draw_block(row, col, block_size)
 
+    @timed("reconstruction")
+    def process_slice(self, compressed_residual, layout, predictions):
+        residuals = self.decompress_residuals(
+            compressed_residual,
+            [qp for _, _, _, qp in layout],
+            [is_sub_block for _, _, is_sub_block, _ in layout],
+        )
+        for residual, (block_seq, sub_block_seq, is_sub_block, _), (frame_seq, row_mv, col_mv) in zip(residuals, layout, predictions):
+            self.reconstruct(frame_seq, block_seq, sub_block_seq, residual, row_mv, col_mv, is_sub_block)
+
+
+def decode_p_slice(height, width, previous_frames: Deque[ReferenceFrame], config: CodecConfig, stats, compressed_residual, layout, predictions):
+    # runs in a worker, returns the slice rows of the reconstruction and the statistics of the slice
+    inter_decoder = InterFrameDecoder(height, width, previous_frames, config)
+    inter_decoder.stats = stats
+    if inter_decoder.stats is not None:
+        inter_decoder.stats.start_frame()
+    inter_decoder.process_slice(compressed_residual, layout, predictions)
+    first_row, _ = inter_decoder.get_position_by_seq(layout[0][0], 0)
+    last_row, _ = inter_decoder.get_position_by_seq(layout[-1][0], 0)
+    slice_stats = inter_decoder.stats.frame if inter_decoder.stats is not None else None
+    return first_row, inter_decoder.frame.data[first_row : last_row + inter_decoder.config.block_size], slice_stats
+
         
+class ChromaDecoder(Coder):
+    """
+    U and V are coded with the decisions made for luma: every block keeps its size, qp, intra
+    mode or reference frame, and luma mvs are halved. Nothing is searched on chroma.
+    """
+    def __init__(self, height, width, config: CodecConfig) -> None:
+        super().__init__(height // 2, width // 2, config.get_chroma_config())
+
+    @staticmethod
+    def get_chroma_mv(mv):
+        # rounded to the closest half-pel, ties to even
+        return float(np.rint(mv)) / 2
+
+    def create_frame_decoder(self, plane, previous_frames: Deque[ReferenceFrame], is_p_frame: bool):
+        if is_p_frame:
+            chroma_frames = Deque([frame.chroma[plane] for frame in previous_frames], maxlen=previous_frames.maxlen)
+            return InterFrameDecoder(self.height, self.width, chroma_frames, self.config)
+        return IntraFrameDecoder(self.height, self.width, self.config)
+
+    def predict_inter_blocks(self, chroma_frames: Deque[ReferenceFrame], layout, predictions, seqs, block_size):
+        # motion compensated blocks of a batch, gathered from the half-pel planes at once
+        rows, cols = self.get_block_positions(layout, seqs)
+        frame_seqs = np.array([predictions[seq][0] for seq in seqs])
+        mvs = np.array([[self.get_chroma_mv(mv) for mv in predictions[seq][1:]] for seq in seqs])
+        offsets = 2 * np.arange(block_size)
+        # integer positions are the even rows and cols of FME_frame
+        fme_rows = (2 * rows + (2 * mvs[:, 0]).astype(np.int64))[:, np.newaxis, np.newaxis] + offsets[:, np.newaxis]
+        fme_cols = (2 * cols + (2 * mvs[:, 1]).astype(np.int64))[:, np.newaxis, np.newaxis] + offsets
+        blocks = np.empty((len(seqs), block_size, block_size), dtype=np.uint8)
+        for frame_seq in np.unique(frame_seqs):
+            is_chosen = frame_seqs == frame_seq
+            blocks[is_chosen] = chroma_frames[frame_seq].FME_frame[fme_rows[is_chosen], fme_cols[is_chosen]]
+        return rows, cols, blocks
+
+    def get_size_groups(self, layout):
+        # residual seqs of each block size
+        for is_sub_block in (False, True):
+            seqs = [seq for seq in range(len(layout)) if bool(layout[seq][2]) == is_sub_block]
+            if seqs:
+                yield is_sub_block, seqs
+
+    @timed("chroma")
+    def process(self, compressed_chroma, layout, predictions, previous_frames: Deque[ReferenceFrame], is_p_frame: bool):
+        # predictions are the luma (frame_seq, row_mv, col_mv) of P frames and the intra modes of I frames
+        qps = [qp for _, _, _, qp in layout]
+        is_sub_blocks = [is_sub_block for _, _, is_sub_block, _ in layout]
+        frames = []
+        for plane, compressed_residual in enumerate(compressed_chroma):
+            frame_decoder = self.create_frame_decoder(plane, previous_frames, is_p_frame)
+            residuals = self.decompress_residuals(compressed_residual, qps, is_sub_blocks)
+            if is_p_frame:
+                # no block reads the plane being built
+                for is_sub_block, seqs in self.get_size_groups(layout):
+                    block_size = self.config.sub_block_size if is_sub_block else self.config.block_size
+                    rows, cols, blocks = self.predict_inter_blocks(frame_decoder.previous_frames, layout, predictions, seqs, block_size)
+                    frame_decoder.frame.put_blocks(rows, cols, blocks + np.stack([residuals[seq] for seq in seqs]))
+            else:
+                frame_decoder.reconstruct_wavefront(layout, residuals, predictions)
+            frames.append(frame_decoder.frame.to_reference_frame())
+        return frames
+
+
 class VideoDecoder(VideoCoder):
     def __init__(self, height, width, config: CodecConfig):
         self.pass_token = 0
         super().__init__(height, width, config)
+        if self.config.ChromaEnable:
+            self.chroma_decoder = ChromaDecoder(height, width, config)
 
     def process_p_frame(self, compressed_data):
         compressed_residual, compressed_descriptors, qp_list = compressed_data[:3]
-        descriptors = self.decompress_descriptors(compressed_descriptors)
+        descriptors_per_residual = 4 if self.config.VBSEnable else 3
+        descriptors = self.decompress_descriptors(compressed_descriptors, descriptors_per_residual * len(compressed_residual))
         inter_decoder = InterFrameDecoder(self.height, self.width, self.previous_frames, self.config)
-        block_seq = 0
-        sub_block_seq = 0
-        last_row_mv, last_col_mv = 0, 0
-        total_sub_blocks = 0
-        if self.config.RCflag == 0:
-            qp = self.config.qp
-        for seq, residual in enumerate(compressed_residual):
-            if self.config.RCflag > 0:
-                if block_seq % self.blocks_per_row == 0:
-                    qp = qp_list[block_seq // self.blocks_per_row]
-            if not self.config.VBSEnable:
-                if self.config.FMEEnable:
-                    row_mv, col_mv = descriptors[seq * 3] / 2 + last_row_mv, descriptors[seq * 3 + 1] / 2 + last_col_mv
-                else:
-                    row_mv, col_mv = descriptors[seq * 3] + last_row_mv, descriptors[seq * 3 + 1] + last_col_mv
-                frame_seq = descriptors[seq * 3 + 2]
-                inter_decoder.process(frame_seq, block_seq, 0, residual, row_mv, col_mv, False, qp)
-                last_row_mv, last_col_mv = row_mv, col_mv
-                block_seq += 1
-            else:
-                is_sub_block = descriptors[seq * 4 + 2] == 1
-                total_sub_blocks += is_sub_block
-                if self.config.FMEEnable:
-                    row_mv, col_mv = descriptors[seq * 4] / 2 + last_row_mv, descriptors[seq * 4 + 1] / 2 + last_col_mv
-                else:
-                    row_mv, col_mv = descriptors[seq * 4] + last_row_mv, descriptors[seq * 4 + 1] + last_col_mv
-                frame_seq = descriptors[seq * 4 + 3]
-                inter_decoder.process(frame_seq, block_seq, sub_block_seq, residual, row_mv, col_mv, is_sub_block, qp)
-                last_row_mv, last_col_mv = row_mv, col_mv
-                if is_sub_block:
-                    sub_block_seq += 1
-                    if sub_block_seq == 4:
-                        sub_block_seq = 0
-                        block_seq += 1
-                else:
-                    block_seq += 1
+        self.attach_stats(inter_decoder)
+        layout, predictions = self.get_block_predictions(descriptors, qp_list, len(compressed_residual))
+        slices = self.get_residual_slices(layout)
+        if self.config.SliceWorkers > 0 and len(slices) > 1 and not self.config.need_display:
+            references = self.get_slice_references()
+            jobs = [
+                self.get_executor().submit(
+                    decode_p_slice, self.height, self.width, references, self.config, self.stats,
+                    compressed_residual[start:stop], layout[start:stop], predictions[start:stop],
+                )
+                for start, stop in slices
+            ]
+            for job in jobs:
+                first_row, reconstructed_rows, slice_stats = job.result()
+                inter_decoder.frame.data[first_row : first_row + len(reconstructed_rows)] = reconstructed_rows
+                if slice_stats is not None:
+                    self.stats.frame.merge(slice_stats)
+        else:
+            inter_decoder.process_slice(compressed_residual, layout, predictions)
+        total_sub_blocks = sum(is_sub_block for _, _, is_sub_block, _ in layout)
         frame = inter_decoder.frame.to_reference_frame()
+        if self.config.ChromaEnable:
+            self.attach_stats(self.chroma_decoder)
+            frame.chroma = self.chroma_decoder.process(compressed_data[4], layout, predictions, self.previous_frames, True)
         self.frame_processed(frame)
         if self.config.need_display:
             if self.config.DisplayRefFrames:
@@ -128,33 +275,35 @@ class VideoDecoder(VideoCoder):
         self.sub_block_ratio = (total_sub_blocks / 4) / len(compressed_residual)
         return frame
 
+    def get_residual_slices(self, layout):
+        # residual ranges of the P frame slices
+        starts = [
+            seq for seq, (block_seq, sub_block_seq, _, _) in enumerate(layout)
+            if seq == 0 or (sub_block_seq == 0 and self.is_slice_start(block_seq))
+        ]
+        return list(zip(starts, starts[1:] + [len(layout)]))
+
     def process_i_frame(self, compressed_data):
         compressed_residual, compressed_descriptors, qp_list = compressed_data[:3]
-        descriptors = self.decompress_descriptors(compressed_descriptors)
+        descriptors_per_residual = 2 if self.config.VBSEnable else 1
+        descriptors = self.decompress_descriptors(compressed_descriptors, descriptors_per_residual * len(compressed_residual))
         intra_decoder = IntraFrameDecoder(self.height, self.width, self.config)
-        block_seq = 0
-        sub_block_seq = 0
-        if self.config.RCflag == 0:
-            qp = self.config.qp
-        for seq, residual in enumerate(compressed_residual):
-            if self.config.RCflag > 0:
-                if block_seq % self.blocks_per_row == 0:
-                    qp = qp_list[block_seq//self.blocks_per_row]
-            if not self.config.VBSEnable:
-                intra_decoder.process(block_seq, 0, residual, descriptors[seq], False, qp)
-                block_seq += 1
-            else:
-                is_sub_block = descriptors[seq * 2 + 1] == 1
-                intra_decoder.process(block_seq, sub_block_seq, residual, descriptors[seq * 2], is_sub_block, qp)
-                if is_sub_block:
-                    sub_block_seq += 1
-                    if sub_block_seq == 4:
-                        sub_block_seq = 0
-                        block_seq += 1
-                else:
-                    block_seq += 1
-                
+        self.attach_stats(intra_decoder)
+        layout, modes = self.get_block_predictions(descriptors, qp_list, len(compressed_residual))
+        residuals = self.decompress_residuals(
+            compressed_residual,
+            [qp for _, _, _, qp in layout],
+            [is_sub_block for _, _, is_sub_block, _ in layout],
+        )
+        if self.config.need_display:
+            for residual, (block_seq, sub_block_seq, is_sub_block, _), mode in zip(residuals, layout, modes):
+                intra_decoder.reconstruct(block_seq, sub_block_seq, residual, mode, is_sub_block)
+        else:
+            intra_decoder.reconstruct_wavefront(layout, residuals, modes)
         frame = intra_decoder.frame.to_reference_frame()
+        if self.config.ChromaEnable:
+            self.attach_stats(self.chroma_decoder)
+            frame.chroma = self.chroma_decoder.process(compressed_data[4], layout, modes, self.previous_frames, False)
         self.frame_processed(frame)
         if self.config.need_display:      
             cv2.imshow("", intra_decoder.display_BW_frame.data)
@@ -162,9 +311,74 @@ class VideoDecoder(VideoCoder):
         return frame
 
     def process(self, compressed_data):
-        if self.config.RCflag > 0:
-            self.frame_seq = compressed_data[3]
+        # rate control may insert I frames, the encoder's frame_seq is authoritative
+        self.frame_seq = compressed_data[3]
+        if self.stats is not None:
+            self.stats.start_frame()
         if self.is_p_frame():
-            return self.process_p_frame(compressed_data)
+            frame = self.process_p_frame(compressed_data)
         else:
-            return self.process_i_frame(compressed_data)
+            frame = self.process_i_frame(compressed_data)
+        if self.stats is not None:
+            self.stats.end_frame(compressed_data[3], self.is_p_frame(compressed_data[3]), compressed_data[2])
+        return frame
+
+
+    def get_replay_start(self, packets, frame_index):
+        # closest frame at or before frame_index decoded right after the deque was cleared
+        start = frame_index
+        while start > 0 and self.is_p_frame(packets.get_frame_seq(start - 1) + 1):
+            start -= 1
+        return start
+
+    def get_references(self, packets, start, stop):
+        """
+        Replays frame_processed on file positions from start to stop. Returns the reference
+        deque of every frame, and the deque left once stop is decoded. start comes from
+        get_replay_start, the deque only holds start - 1 then, -1 being the initial gray frame.
+        """
+        references = Deque([start - 1], maxlen=self.config.nRefFrames)
+        frame_references = dict()
+        for frame_index in range(start, stop + 1):
+            # I frames do not read their references
+            frame_references[frame_index] = list(references) if packets.is_p_frame(frame_index) else []
+            if not self.is_p_frame(packets.get_frame_seq(frame_index) + 1):
+                references.clear()
+            references.append(frame_index)
+        return frame_references, list(references)
+
+    def get_decode_plan(self, packets, frames):
+        """
+        Frames to decode, in order, with the references each one needs, so that every frame of
+        frames gets reconstructed. With nRefFrames > 1 the first P frames of a GOP still
+        reference the frame before its I frame, that frame is then planned from its own GOP.
+        """
+        last = max(frames)
+        start = self.get_replay_start(packets, last)
+        frame_references, _ = self.get_references(packets, start, last)
+        needed = set(frames)
+        for frame_index in range(last, start - 1, -1):
+            if frame_index in needed:
+                needed.update(frame_references[frame_index])
+        earlier = [frame_index for frame_index in needed if 0 <= frame_index < start]
+        plan = self.get_decode_plan(packets, earlier) if earlier else dict()
+        for frame_index in sorted(needed):
+            if frame_index >= start:
+                plan[frame_index] = frame_references[frame_index]
+        return plan
+
+    def seek(self, packets, frame_index):
+        """
+        Decodes frame frame_index of packets (anything with read, is_p_frame and get_frame_seq,
+        like BitstreamReader) from the closest I frame instead of from the first frame.
+        Afterwards the decoder holds the same references as after a sequential decode, so
+        process can carry on with frame_index + 1.
+        """
+        start = self.get_replay_start(packets, frame_index)
+        _, state = self.get_references(packets, start, frame_index)
+        frames = {-1: self.get_initial_reference()}
+        for seq, references in self.get_decode_plan(packets, [seq for seq in state if seq >= 0]).items():
+            self.previous_frames = Deque([frames[reference] for reference in references], maxlen=self.config.nRefFrames)
+            frames[seq] = self.process(packets.read(seq))
+        self.previous_frames = Deque([frames[reference] for reference in state], maxlen=self.config.nRefFrames)
+        return frames[frame_index]
@@ -1,70 +1,63 @@
-from PixelPerfect.Yuv import YuvBlock, ReferenceFrame
+from PixelPerfect.Yuv import YuvBlock, YuvFrame, ReferenceFrame
 from PixelPerfect.Coder import Coder, VideoCoder
-from PixelPerfect.Decoder import IntraFrameDecoder, InterFrameDecoder
+from PixelPerfect.Decoder import IntraFrameDecoder, InterFrameDecoder, ChromaDecoder
 from PixelPerfect.CodecConfig import CodecConfig
 from PixelPerfect.BitRateController import BitRateController
+from PixelPerfect.MotionField import MotionField, PyramidMotionField, SeededMotionField
+from PixelPerfect.Stats import timed
+from itertools import islice
 from typing import Deque
+import numpy as np
 import copy
 class InterFrameEncoder(Coder):
     def __init__(self, height, width, previous_frames: Deque[ReferenceFrame], config: CodecConfig):
         super().__init__(height, width, config)
         self.previous_frames = previous_frames
         self.inter_decoder = InterFrameDecoder(height, width, previous_frames, config)
-
-    def is_better_match_block(
-        self, block: YuvBlock, ref_block: YuvBlock, min_mae, best_i, best_j
-    ) -> bool:
-        mae = block.get_mae(ref_block)
-        if mae > min_mae:
-            return False, None
-        if mae < min_mae:
-            return True, mae
-        di = block.row - ref_block.row
-        dj = block.col - ref_block.col
-        # if mae is equal, we need to compare the distance
-        if abs(di) + abs(dj) > abs(best_i - block.row) + abs(best_j - block.col):
-            return False, None
-        if abs(di) + abs(dj) < abs(best_i - block.row) + abs(best_j - block.col):
-            return True, mae
-        # if distance is equal, we prefer the smaller di
-        if di > best_i - block.row:
-            return False, None
-        if di < best_i - block.row:
-            return True, mae
-        # if di is equal, we prefer the smaller dj
-        if dj < best_j - block.col:
-            return True, mae
-        return False, None
+        self.motion_field = None
+        # epzs candidates: (row_mv, col_mv, mae) of every block searched so far, by block row and col,
+        # and the mvs of the previous P frame by block row and col
+        self.searched_mvs = dict()
+        self.colocated_mvs = None
+        # fast search candidates of every block by block row and col, (ref_frame_seq, row_mv, col_mv,
+        # 2x2 SADs of the sub-blocks), the sub-blocks pick their mvs among them
+        self.quadrant_sads = dict()
 
     def get_inter_data_fast_search(self, block: YuvBlock, mv_row_pred, mv_col_pred):
         best_block_among_all_frames = None
         best_mae_among_all_frames = float("inf")
         best_ref_frame_seq = None
+        sad_evaluations, candidates_visited = 0, 0
         for ref_frame_seq, ref_frame in enumerate(self.previous_frames):
             best_block = ref_frame.get_block(
                 min(max(0, block.row + mv_row_pred), self.height - block.block_size),
                 min(max(0, block.col + mv_col_pred), self.width - block.block_size),
                 block.block_size == self.config.sub_block_size,
             )
-            best_mae = block.get_mae(best_block)
+            best_mae = self.get_candidate_block_mae(block, ref_frame_seq, best_block)
+            sad_evaluations += 1
+            candidates_visited += 1
             has_gain = True
             within_limit = True
             while has_gain and within_limit:
                 has_gain = False
                 # do cross area search
                 for ref_block in ref_frame.get_ref_blocks_in_cross_area(best_block):
-                    ref_block_mae = block.get_mae(ref_block)
+                    ref_block_mae = self.get_candidate_block_mae(block, ref_frame_seq, ref_block)
+                    sad_evaluations += 1
                     if ref_block_mae < best_mae:
                         best_block = ref_block
                         best_mae = ref_block_mae
                         has_gain = True
+                candidates_visited += has_gain
                 if has_gain and max(abs(best_block.row - block.row), abs(best_block.col - block.col)) >= self.config.FastME_LIMIT:
                     within_limit = False
             if best_mae < best_mae_among_all_frames:
                 best_block_among_all_frames = best_block
                 best_mae_among_all_frames = best_mae
                 best_ref_frame_seq = ref_frame_seq
-            
+        if self.stats is not None:
+            self.stats.frame.add_search("fast", sad_evaluations, candidates_visited)
         return (
             block.get_residual(best_block_among_all_frames),
             best_block_among_all_frames.row - block.row,
@@ -72,28 +65,138 @@ class InterFrameEncoder(Coder):
             best_ref_frame_seq
         )
 
-    def get_inter_data_normal_search(self, block: YuvBlock) :
-        min_mae = float("inf")
-        best_i, best_j = None, None
-        best_di, best_dj = None, None
-        best_block = None
-        best_frame_seq = None
-        for frame_seq, ref_frame in enumerate(self.previous_frames):
-            for ref_block in ref_frame.get_ref_blocks_in_offset_area(block):
-                is_better_match, mae = self.is_better_match_block(block, ref_block, min_mae, best_i, best_j)
-                if is_better_match:
-                    min_mae = mae
-                    best_i, best_j = ref_block.row, ref_block.col
-                    best_di, best_dj = ref_block.row - block.row, ref_block.col - block.col
-                    best_block = ref_block
-                    best_frame_seq = frame_seq
-        return block.get_residual(best_block), best_di, best_dj, best_frame_seq
+    def get_neighbour_mvs(self, block_row, block_col):
+        # left, top and top-right blocks, a slice worker never sees the blocks of another slice
+        first_row = block_row - block_row % self.config.SliceRows if self.config.SliceRows > 0 else 0
+        return [
+            self.searched_mvs[(row, col)]
+            for row, col in ((block_row, block_col - 1), (block_row - 1, block_col), (block_row - 1, block_col + 1))
+            if row >= first_row and (row, col) in self.searched_mvs
+        ]
+
+    def get_candidate_block_mae(self, block: YuvBlock, ref_frame_seq, ref_block: YuvBlock):
+        # a VBS block also keeps the SADs of its four sub-blocks against the candidate
+        if not self.config.VBSEnable or self.config.FastME_SUB_BLOCK_SEARCH or block.block_size != self.config.block_size:
+            return block.get_mae(ref_block)
+        sub_block_size = self.config.sub_block_size
+        diff = np.abs(block.get_signed_data() - ref_block.get_signed_data())
+        sads = diff.reshape(2, sub_block_size, 2, sub_block_size).sum(axis=(1, 3))
+        self.quadrant_sads.setdefault((int(block.row) // self.config.block_size, int(block.col) // self.config.block_size), []).append(
+            (ref_frame_seq, ref_block.row - block.row, ref_block.col - block.col, sads)
+        )
+        return sads.sum() / diff.size
+
+    def get_inter_data_from_block_search(self, sub_block: YuvBlock):
+        # best candidate of the search of the block for this sub-block, the first one scored among equals
+        block_row, row = divmod(int(sub_block.row), self.config.block_size)
+        block_col, col = divmod(int(sub_block.col), self.config.block_size)
+        quadrant = (row // self.config.sub_block_size, col // self.config.sub_block_size)
+        frame_seq, row_mv, col_mv, _ = min(self.quadrant_sads[(block_row, block_col)], key=lambda candidate: candidate[3][quadrant])
+        best_block = self.previous_frames[frame_seq].get_block(sub_block.row + row_mv, sub_block.col + col_mv, True)
+        return sub_block.get_residual(best_block), row_mv, col_mv, frame_seq
+
+    def get_candidate_mae(self, block: YuvBlock, ref_frame_seq, row_mv, col_mv, maes):
+        # maes keeps the candidates already scored, the ones outside the frame or the limit are never picked
+        if (row_mv, col_mv) not in maes:
+            row, col = block.row + row_mv, block.col + col_mv
+            # blocks are laid out on the padded frame
+            height, width = self.previous_frames[ref_frame_seq].data.shape
+            if (
+                max(abs(row_mv), abs(col_mv)) > self.config.FastME_LIMIT
+                or row < 0 or row > height - block.block_size
+                or col < 0 or col > width - block.block_size
+            ):
+                maes[(row_mv, col_mv)] = float("inf")
+            else:
+                ref_block = self.previous_frames[ref_frame_seq].get_block(row, col, block.block_size == self.config.sub_block_size)
+                maes[(row_mv, col_mv)] = self.get_candidate_block_mae(block, ref_frame_seq, ref_block)
+        return maes[(row_mv, col_mv)]
 
+    def get_inter_data_epzs_search(self, block: YuvBlock, mv_row_pred, mv_col_pred):
+        """
+        Predictive zonal search. The best of the predicted mvs (the mv predictor, zero, the left,
+        top and top-right blocks, the same block in the previous P frame, and for a sub-block its
+        block) moves to the best point of the large diamond around it until it stays put, then
+        once to the best point of the small diamond. The search stops below an MAE of 1, and the
+        large diamond is skipped when the candidate is already about as good as its neighbours.
+        """
+        unit = 0.5 if self.config.FMEEnable else 1
+        large_diamond = [(-2, 0), (2, 0), (0, -2), (0, 2), (-1, -1), (-1, 1), (1, -1), (1, 1)]
+        small_diamond = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+        block_row, block_col = int(block.row) // self.config.block_size, int(block.col) // self.config.block_size
+        neighbours = self.get_neighbour_mvs(block_row, block_col)
+        candidates = [(mv_row_pred, mv_col_pred), (0, 0)] + [(row_mv, col_mv) for row_mv, col_mv, _ in neighbours]
+        if self.colocated_mvs is not None:
+            candidates.append(tuple(self.colocated_mvs[block_row, block_col].tolist()))
+        is_sub_block = block.block_size == self.config.sub_block_size
+        if is_sub_block and (block_row, block_col) in self.searched_mvs:
+            candidates.append(self.searched_mvs[(block_row, block_col)][:2])
+        early_exit = 1
+        adaptive_exit = 1.2 * min(mae for _, _, mae in neighbours) + 0.5 if neighbours else early_exit
+        best_ref_frame_seq = None
+        sad_evaluations, candidates_visited = 0, 0
+        for ref_frame_seq in range(len(self.previous_frames)):
+            maes = dict()
+            best_mv = min(candidates, key=lambda mv: self.get_candidate_mae(block, ref_frame_seq, *mv, maes))
+            best_mae = maes[best_mv]
+            candidates_visited += 1
+            diamonds = []
+            if best_mae > early_exit:
+                diamonds = [small_diamond] if best_mae <= adaptive_exit else [large_diamond, small_diamond]
+            for diamond in diamonds:
+                has_gain = True
+                while has_gain:
+                    has_gain = False
+                    center = best_mv
+                    for row_move, col_move in diamond:
+                        mv = (center[0] + row_move * unit, center[1] + col_move * unit)
+                        if self.get_candidate_mae(block, ref_frame_seq, *mv, maes) < best_mae:
+                            best_mv, best_mae = mv, maes[mv]
+                            has_gain = True
+                    candidates_visited += has_gain
+                    # the small diamond moves once
+                    has_gain = has_gain and diamond is large_diamond
+            sad_evaluations += sum(1 for mae in maes.values() if mae != float("inf"))
+            if best_ref_frame_seq is None or best_mae < best_mae_among_all_frames:
+                best_mae_among_all_frames = best_mae
+                best_row_mv, best_col_mv = best_mv
+                best_ref_frame_seq = ref_frame_seq
+        if not is_sub_block:
+            self.searched_mvs[(block_row, block_col)] = (best_row_mv, best_col_mv, best_mae_among_all_frames)
+        if self.stats is not None:
+            self.stats.frame.add_search("epzs", sad_evaluations, candidates_visited)
+        best_block = self.previous_frames[best_ref_frame_seq].get_block(block.row + best_row_mv, block.col + best_col_mv, is_sub_block)
+        return block.get_residual(best_block), best_row_mv, best_col_mv, best_ref_frame_seq
+
+    @timed("motion_estimation")
+    def prepare_motion_field(self, frame: ReferenceFrame, seed_tables=None):
+        # the integer full search only reads reconstructed frames, so the whole frame is searched up front,
+        # seed_tables are the motion field tables of a first pass to start from
+        if seed_tables is not None:
+            self.motion_field = SeededMotionField(self.config, frame, self.previous_frames, seed_tables)
+        elif self.config.PyramidME:
+            self.motion_field = PyramidMotionField(self.config, frame, self.previous_frames)
+        elif not self.config.FastME:
+            self.motion_field = MotionField(self.config, frame, self.previous_frames)
+        if self.motion_field is not None and self.stats is not None:
+            search = "seeded" if seed_tables is not None else "pyramid" if self.config.PyramidME else "normal"
+            field = self.motion_field
+            self.stats.frame.add_search(search, field.sad_count, field.sad_count + field.skipped_count)
+
+    @timed("motion_estimation")
     def get_inter_data(self, block: YuvBlock, last_row_mv, last_col_mv):
         if self.config.FastME:
+            block_key = (int(block.row) // self.config.block_size, int(block.col) // self.config.block_size)
+            if block.block_size == self.config.sub_block_size and block_key in self.quadrant_sads:
+                return self.get_inter_data_from_block_search(block)
+            if self.config.FastME_METHOD == "epzs":
+                return self.get_inter_data_epzs_search(block, last_row_mv, last_col_mv)
             return self.get_inter_data_fast_search(block, last_row_mv, last_col_mv)
-        else:
-            return self.get_inter_data_normal_search(block)
+        row_mv, col_mv, frame_seq = self.motion_field.get_inter_data(block)
+        best_block = self.previous_frames[frame_seq].get_block_by_mv(
+            block.row, block.col, row_mv, col_mv, block.block_size
+        )
+        return block.get_residual(best_block), row_mv, col_mv, frame_seq
 
     # this function should be idempotent
     def process(self, block: YuvBlock, block_seq: int, last_row_mv: int, last_col_mv: int, use_sub_blocks: bool, qp: int):
@@ -101,11 +204,12 @@ class InterFrameEncoder(Coder):
         descriptors = []
         residual_bitrate = 0
         if use_sub_blocks:
-            for sub_block_seq, sub_block in enumerate(block.get_sub_blocks()):
+            # motion search only reads reference frames, so the four sub-blocks are coded as one batch
+            residuals, inter_data = [], []
+            for sub_block in block.get_sub_blocks():
                 residual, row_mv, col_mv, frame_seq = self.get_inter_data(sub_block, last_row_mv, last_col_mv)
-                residual, bitrate = self.compress_residual(residual, qp=qp, is_sub_block=True)
-                compressed_residual.append(residual)
-                residual_bitrate += bitrate
+                residuals.append(residual)
+                inter_data.append((row_mv, col_mv, frame_seq))
                 if self.config.FMEEnable:
                     descriptors.append(int(2 * (row_mv - last_row_mv)))
                     descriptors.append(int(2 * (col_mv - last_col_mv)))
@@ -115,7 +219,11 @@ class InterFrameEncoder(Coder):
                 descriptors.append(1)
                 descriptors.append(frame_seq)
                 last_row_mv, last_col_mv = row_mv, col_mv
-                self.inter_decoder.process(frame_seq, block_seq, sub_block_seq, residual, row_mv, col_mv, is_sub_block=True, qp=qp)
+            compressed_residual, bitrates = self.compress_residuals(residuals, [qp] * 4, [True] * 4)
+            residual_bitrate += sum(bitrates)
+            residuals = self.inter_decoder.decompress_residuals(compressed_residual, [qp] * 4, [True] * 4)
+            for sub_block_seq, (residual, (row_mv, col_mv, frame_seq)) in enumerate(zip(residuals, inter_data)):
+                self.inter_decoder.reconstruct(frame_seq, block_seq, sub_block_seq, residual, row_mv, col_mv, is_sub_block=True)
         else:
             residual, row_mv, col_mv, frame_seq = self.get_inter_data(block, last_row_mv, last_col_mv)
             residual, bitrate = self.compress_residual(residual, qp=qp, is_sub_block=False)
@@ -150,6 +258,7 @@ class IntraFrameEncoder(Coder):
         self.frame = current_frame
         self.intra_decoder = IntraFrameDecoder(height, width, config)
             
+    @timed("intra_prediction")
     def get_intra_data(self, block: YuvBlock):
         vertical_ref = self.intra_decoder.frame.get_vertical_ref_block(
             block.row, block.col, block.block_size == self.config.sub_block_size
@@ -192,46 +301,215 @@ class IntraFrameEncoder(Coder):
         distortion = block.get_SAD(reconstructed_block)
         return compressed_residual, descriptors, distortion, residual_bitrate
 
+    @timed("intra_prediction")
+    def get_intra_data_blocks(self, frame: ReferenceFrame, rows, cols, block_size):
+        # get_intra_data of independent blocks as one batch, with the predictions
+        blocks = frame.take_blocks(rows, cols, block_size).astype(np.int16)
+        vertical, horizontal = self.intra_decoder.predict_blocks(rows, cols, block_size)
+        # comparing SADs of equal sized blocks is comparing their MAEs
+        vertical_sads = np.abs(blocks - vertical.astype(np.int16)).sum(axis=(1, 2))
+        horizontal_sads = np.abs(blocks - horizontal.astype(np.int16)).sum(axis=(1, 2))
+        modes = np.where(vertical_sads < horizontal_sads, 0, 1)
+        predictions = np.where(modes[:, np.newaxis, np.newaxis] == 0, vertical, horizontal)
+        return blocks - predictions.astype(np.int16), modes, predictions
+
+    @timed("intra_prediction")
+    def process_blocks(self, frame: ReferenceFrame, rows, cols, qps, is_sub_block: bool):
+        # process of independent blocks as one batch, their reconstruction is put into the frame
+        block_size = self.config.sub_block_size if is_sub_block else self.config.block_size
+        residuals, modes, predictions = self.get_intra_data_blocks(frame, rows, cols, block_size)
+        is_sub_blocks = [is_sub_block] * len(rows)
+        quantized = self.quantize_residuals(residuals, qps, is_sub_blocks)
+        compressed_residual, bitrates = self.entrophy_code_residuals(quantized, is_sub_blocks)
+        residuals = self.intra_decoder.dequantize_residuals(quantized, qps, is_sub_blocks)
+        self.intra_decoder.frame.put_blocks(rows, cols, predictions + residuals)
+        return modes.tolist(), compressed_residual, bitrates
+
+    def get_distortions(self, frame: ReferenceFrame, rows, cols):
+        blocks = frame.take_blocks(rows, cols, self.config.block_size).astype(np.int16)
+        reconstructed = self.intra_decoder.frame.take_blocks(rows, cols, self.config.block_size).astype(np.int16)
+        return np.abs(blocks - reconstructed).sum(axis=(1, 2)).tolist()
+
+    def process_wavefront(self, frame: ReferenceFrame, qps, calculate_RDO):
+        """
+        Codes every block of the frame as the block by block loop does, one anti-diagonal of
+        blocks at a time: a block only reads the row above and the column left of it, so the
+        blocks of a diagonal are independent. Sub-blocks follow the same order inside their
+        blocks. Returns use_sub_blocks, compressed_residual, descriptors and residual_bitrate
+        of every block.
+        """
+        block_size, sub_block_size = self.config.block_size, self.config.sub_block_size
+        block_rows, block_cols = frame.height // block_size, self.row_block_num
+        results = [None] * (block_rows * block_cols)
+        for diagonal in range(block_rows + block_cols - 1):
+            block_row = np.arange(max(0, diagonal - block_cols + 1), min(diagonal, block_rows - 1) + 1)
+            block_seqs = (block_row * block_cols + diagonal - block_row).tolist()
+            rows, cols = block_row * block_size, (diagonal - block_row) * block_size
+            block_qps = [qps[block_seq] for block_seq in block_seqs]
+            modes, normal_residual, normal_bitrates = self.process_blocks(frame, rows, cols, block_qps, False)
+            if not self.config.VBSEnable:
+                for index, block_seq in enumerate(block_seqs):
+                    results[block_seq] = (False, [normal_residual[index]], [modes[index]], normal_bitrates[index])
+                continue
+            normal_distortions = self.get_distortions(frame, rows, cols)
+            normal_blocks = self.intra_decoder.frame.take_blocks(rows, cols, block_size)
+            sub_blocks_residual = [[None] * 4 for _ in block_seqs]
+            sub_blocks_descriptors = [[None] * 8 for _ in block_seqs]
+            sub_blocks_residual_bitrates = [0] * len(block_seqs)
+            # sub-blocks 1 and 2 only read sub-block 0, sub-block 3 reads them both
+            for sub_block_seqs in ((0,), (1, 2), (3,)):
+                sub_rows = np.concatenate([rows + sub_block_seq // 2 * sub_block_size for sub_block_seq in sub_block_seqs])
+                sub_cols = np.concatenate([cols + sub_block_seq % 2 * sub_block_size for sub_block_seq in sub_block_seqs])
+                sub_modes, sub_residual, sub_bitrates = self.process_blocks(
+                    frame, sub_rows, sub_cols, block_qps * len(sub_block_seqs), True
+                )
+                for sub_index, sub_block_seq in enumerate(sub_block_seqs):
+                    for index in range(len(block_seqs)):
+                        batch_index = sub_index * len(block_seqs) + index
+                        sub_blocks_residual[index][sub_block_seq] = sub_residual[batch_index]
+                        sub_blocks_descriptors[index][2 * sub_block_seq : 2 * sub_block_seq + 2] = [sub_modes[batch_index], 1]
+                        sub_blocks_residual_bitrates[index] += sub_bitrates[batch_index]
+            sub_blocks_distortions = self.get_distortions(frame, rows, cols)
+            is_normal = np.zeros(len(block_seqs), dtype=bool)
+            for index, block_seq in enumerate(block_seqs):
+                normal_bitrate = normal_bitrates[index] + 2
+                sub_blocks_bitrate = sub_blocks_residual_bitrates[index] + len(sub_blocks_descriptors[index])
+                if calculate_RDO(normal_bitrate, normal_distortions[index]) > calculate_RDO(sub_blocks_bitrate, sub_blocks_distortions[index]):
+                    results[block_seq] = (True, sub_blocks_residual[index], sub_blocks_descriptors[index], sub_blocks_residual_bitrates[index])
+                else:
+                    is_normal[index] = True
+                    results[block_seq] = (False, [normal_residual[index]], [modes[index], 0], normal_bitrates[index])
+            # roll back the blocks that keep their normal reconstruction
+            self.intra_decoder.frame.put_blocks(rows[is_normal], cols[is_normal], normal_blocks[is_normal])
+        return results
+
+
+class ChromaEncoder(ChromaDecoder):
+    @timed("chroma")
+    def process(self, frame: ReferenceFrame, layout, predictions, previous_frames: Deque[ReferenceFrame], is_p_frame: bool):
+        compressed_chroma = []
+        bitrate = 0
+        frames = []
+        for plane, current in enumerate(frame.chroma):
+            frame_decoder = self.create_frame_decoder(plane, previous_frames, is_p_frame)
+            if is_p_frame:
+                compressed_residual, bitrates = self.process_inter_plane(current, frame_decoder, layout, predictions)
+            else:
+                compressed_residual, bitrates = self.process_intra_plane(current, frame_decoder, layout, predictions)
+            compressed_chroma.append(compressed_residual)
+            bitrate += sum(bitrates)
+            frames.append(frame_decoder.frame.to_reference_frame())
+        return compressed_chroma, bitrate, frames
+
+    def process_inter_plane(self, current: ReferenceFrame, inter_decoder: InterFrameDecoder, layout, predictions):
+        # predictions do not depend on the plane being built, each block size is one batch
+        compressed_residual, bitrates = [None] * len(layout), [0] * len(layout)
+        for is_sub_block, seqs in self.get_size_groups(layout):
+            block_size = self.config.sub_block_size if is_sub_block else self.config.block_size
+            rows, cols, ref_blocks = self.predict_inter_blocks(inter_decoder.previous_frames, layout, predictions, seqs, block_size)
+            offsets = np.arange(block_size)
+            blocks = current.data[
+                rows[:, np.newaxis, np.newaxis] + offsets[:, np.newaxis],
+                cols[:, np.newaxis, np.newaxis] + offsets,
+            ]
+            qps = [layout[seq][3] for seq in seqs]
+            residuals, group_bitrates = self.compress_residuals(
+                blocks.astype(np.int16) - ref_blocks.astype(np.int16), qps, [is_sub_block] * len(seqs)
+            )
+            decompressed = inter_decoder.decompress_residuals(residuals, qps, [is_sub_block] * len(seqs))
+            inter_decoder.frame.put_blocks(rows, cols, ref_blocks + np.stack(decompressed))
+            for seq, residual, bitrate in zip(seqs, residuals, group_bitrates):
+                compressed_residual[seq] = residual
+                bitrates[seq] = bitrate
+        return compressed_residual, bitrates
+
+    def process_intra_plane(self, current: ReferenceFrame, intra_decoder: IntraFrameDecoder, layout, modes):
+        # blocks are predicted from the ones reconstructed before them, each wavefront is one batch
+        quantized = [None] * len(layout)
+        modes = np.asarray(modes)
+        for wave in intra_decoder.get_waves(layout):
+            for is_sub_block in (False, True):
+                seqs = [seq for seq in wave if bool(layout[seq][2]) == is_sub_block]
+                if not seqs:
+                    continue
+                block_size = self.config.sub_block_size if is_sub_block else self.config.block_size
+                rows, cols = self.get_block_positions(layout, seqs)
+                vertical, horizontal = intra_decoder.predict_blocks(rows, cols, block_size)
+                predictions = np.where(modes[seqs][:, np.newaxis, np.newaxis] == 0, vertical, horizontal)
+                qps = [layout[seq][3] for seq in seqs]
+                is_sub_blocks = [is_sub_block] * len(seqs)
+                residuals = current.take_blocks(rows, cols, block_size).astype(np.int16) - predictions.astype(np.int16)
+                residuals = self.quantize_residuals(residuals, qps, is_sub_blocks)
+                for seq, residual in zip(seqs, residuals):
+                    quantized[seq] = residual
+                residuals = self.dequantize_residuals(residuals, qps, is_sub_blocks)
+                intra_decoder.frame.put_blocks(rows, cols, predictions + residuals)
+        return self.entrophy_code_residuals(quantized, [is_sub_block for _, _, is_sub_block, _ in layout])
+
 
 class VideoEncoder(VideoCoder):
     def __init__(self, height, width, config: CodecConfig):
         super().__init__(height, width, config)
         self.bitrate = 0
         self.bitrate_controller = BitRateController(height, width, config)
+        # mvs of the last P frame for the epzs search, none after an I frame
+        self.colocated_mvs = None
+        # motion field tables of the last frame of a first pass, and of the first pass of this frame
+        self.motion_tables = None
+        self.seed_tables = None
         if self.config.RCflag > 1:
             fist_config = copy.deepcopy(config)
             fist_config.i_Period = -1
             fist_config.RCflag = 0
             fist_config.is_firstpass = True
+            fist_config.ChromaEnable = False
             self.firstpass_encoder = VideoEncoder(height, width, fist_config)
+        if self.config.ChromaEnable:
+            self.chroma_encoder = ChromaEncoder(height, width, config)
+
+    def process_chroma(self, frame: ReferenceFrame, decoded_frame: ReferenceFrame, descriptors, residual_count):
+        if frame.chroma is None:
+            raise Exception("Error! ChromaEnable needs frames read with their U and V planes")
+        # the mvs of rate control 3 are coded from the ones of the first pass
+        block_mvs = self.mv_list if self.config.RCflag == 3 else None
+        layout, predictions = self.get_block_predictions(descriptors, self.qp_list, residual_count, block_mvs)
+        self.attach_stats(self.chroma_encoder)
+        compressed_chroma, bitrate, decoded_frame.chroma = self.chroma_encoder.process(
+            frame, layout, predictions, self.previous_frames, self.is_p_frame()
+        )
+        if self.stats is not None:
+            self.stats.frame.bits["chroma"] += bitrate
+        self.bitrate_controller.use_chroma_bit_count(bitrate, self.is_i_frame())
+        self.bitrate += bitrate
+        self.frame_bitrate += bitrate
+        return compressed_chroma
+
     def calculate_RDO(self, bitrate, distortion):
         return distortion + self.config.RD_lambda * bitrate
 
-    def process_p_frame(self, frame: ReferenceFrame):
+    def process_p_slice(self, frame: ReferenceFrame, frame_encoder: InterFrameEncoder, first_block, stop_block):
+        # blocks of a slice only depend on each other, the mv predictor and rate control rows start over
         compressed_residual = []
         descriptors = []
-        self.qp_list = []
+        qp_list = []
         last_row_mv, last_col_mv = 0, 0
-        frame_encoder = InterFrameEncoder(self.height, self.width, self.previous_frames, self.config)
-        frame_bitrate = 0
-        self.bitrate_controller.refresh_frame()
-        self.per_row_bit = []
+        slice_bitrate = 0
+        per_row_bit = []
         row_bit = 0
-        if self.config.is_firstpass:
-            self.vbs_token = []
-            self.mv_list = []
-        for block_seq, block in enumerate(frame.get_blocks()):
+        vbs_token = []
+        mv_list = []
+        if self.config.SliceRows > 0:
+            self.bitrate_controller.refresh_slice(first_block // self.row_block_num, stop_block // self.row_block_num)
+        for block_seq, block in islice(enumerate(frame.get_blocks()), first_block, stop_block):
             use_sub_blocks = True
             if self.config.RCflag == 3:
                 if not self.vbs_token[block_seq]:
                     use_sub_blocks = False
-                last_row_mv = self.mv_list[0][0]
-                last_col_mv = self.mv_list[0][1]
-                self.mv_list.pop(0)
+                last_row_mv, last_col_mv = self.mv_list[block_seq]
             if block_seq % self.blocks_per_row == 0:
                 qp = self.bitrate_controller.get_qp(is_i_frame=False)
                 self.bitrate_controller.update_used_rows()
-                self.qp_list.append(qp)
+                qp_list.append(qp)
             (
                 normal_residual,
                 normal_descriptors,
@@ -243,6 +521,8 @@ class VideoEncoder(VideoCoder):
             normal_bitrate = normal_residual_bitrate + len(normal_descriptors)
             if self.config.VBSEnable:
                 if use_sub_blocks:
+                    # keep the normal block reconstruction, the sub blocks trial overwrites it
+                    normal_snapshot = frame_encoder.inter_decoder.snapshot(block_seq)
                     (
                         sub_blocks_residual,
                         sub_blocks_descriptors,
@@ -253,9 +533,9 @@ class VideoEncoder(VideoCoder):
                     ) = frame_encoder.process(block, block_seq, last_row_mv, last_col_mv, use_sub_blocks=True, qp=qp)
                     sub_blocks_bitrate = sub_blocks_residual_bitrate + len(sub_blocks_descriptors)
                     use_sub_blocks = self.calculate_RDO(normal_bitrate, normal_distortion) > self.calculate_RDO(sub_blocks_bitrate, sub_blocks_distortion)
-                    # roll back normal block status
-                if not use_sub_blocks:
-                    _ = frame_encoder.process(block, block_seq, last_row_mv, last_col_mv, use_sub_blocks=False, qp=qp)
+                    if not use_sub_blocks:
+                        # roll back normal block status
+                        frame_encoder.inter_decoder.rollback(normal_snapshot)
             else:
                 use_sub_blocks = False
             block_bitrate = 0
@@ -264,7 +544,7 @@ class VideoEncoder(VideoCoder):
                 descriptors += sub_blocks_descriptors
                 descriptor_bitrate = self.cal_entrophy_bitcount(sub_blocks_descriptors)
                 block_bitrate = sub_blocks_residual_bitrate + descriptor_bitrate
-                frame_bitrate += block_bitrate
+                slice_bitrate += block_bitrate
                 last_row_mv, last_col_mv = sub_blocks_last_row_mv, sub_blocks_last_col_mv
             else:
                 compressed_residual += normal_residual
@@ -272,36 +552,106 @@ class VideoEncoder(VideoCoder):
                 descriptor_bitrate = self.cal_entrophy_bitcount(normal_descriptors)
                 last_row_mv, last_col_mv = normal_last_row_mv, normal_last_col_mv
                 block_bitrate = normal_residual_bitrate + descriptor_bitrate
-                frame_bitrate += block_bitrate
+                slice_bitrate += block_bitrate
+            if self.stats is not None:
+                self.stats.count_block(
+                    block_bitrate - descriptor_bitrate,
+                    descriptor_bitrate,
+                    sub_blocks_descriptors if use_sub_blocks else normal_descriptors,
+                    True,
+                    self.config.VBSEnable and (self.config.RCflag != 3 or self.vbs_token[block_seq]),
+                    use_sub_blocks,
+                )
             if self.config.RCflag > 0:
                 self.bitrate_controller.use_bit_count_for_a_frame(block_bitrate)
             if self.config.is_firstpass:
-                self.vbs_token.append(use_sub_blocks)
-                self.mv_list.append((last_row_mv, last_col_mv))
+                vbs_token.append(use_sub_blocks)
+                mv_list.append((last_row_mv, last_col_mv))
                 row_bit += block_bitrate
                 if block_seq >0 and (block_seq+1) % self.blocks_per_row == 0:
-                    self.per_row_bit.append(row_bit)
+                    per_row_bit.append(row_bit)
                     row_bit = 0
+        return compressed_residual, descriptors, qp_list, slice_bitrate, per_row_bit, vbs_token, mv_list
+
+    def process_p_frame(self, frame: ReferenceFrame):
+        frame_encoder = InterFrameEncoder(self.height, self.width, self.previous_frames, self.config)
+        frame_encoder.colocated_mvs = self.colocated_mvs
+        self.attach_stats(frame_encoder, frame_encoder.inter_decoder)
+        frame_encoder.prepare_motion_field(frame, self.seed_tables)
+        if self.config.is_firstpass and frame_encoder.motion_field is not None:
+            self.motion_tables = frame_encoder.motion_field.tables
+        self.bitrate_controller.refresh_frame(is_i_frame=False)
+        slices = self.get_slices()
+        if self.config.SliceWorkers > 0 and len(slices) > 1 and not self.config.need_display:
+            # the motion field is searched once, a worker gets the rows of its slice and of its motion field
+            slice_encoder = self.get_slice_encoder()
+            jobs = []
+            for first_block, stop_block in slices:
+                first_row = first_block // self.row_block_num * self.config.block_size
+                stop_row = stop_block // self.row_block_num * self.config.block_size
+                motion_field = None if frame_encoder.motion_field is None else frame_encoder.motion_field.get_rows(first_row, stop_row)
+                jobs.append(self.get_executor().submit(
+                    encode_p_slice, slice_encoder, frame.data[first_row:stop_row], frame.data.shape, first_row,
+                    motion_field, frame_encoder.colocated_mvs, first_block, stop_block,
+                ))
+            results = []
+            for job, (first_block, stop_block) in zip(jobs, slices):
+                result, reconstructed_rows, slice_stats = job.result()
+                first_row = first_block // self.row_block_num * self.config.block_size
+                frame_encoder.inter_decoder.frame.data[first_row : first_row + len(reconstructed_rows)] = reconstructed_rows
+                if slice_stats is not None:
+                    self.stats.frame.merge(slice_stats)
+                results.append(result)
+        else:
+            results = [self.process_p_slice(frame, frame_encoder, *bounds) for bounds in slices]
+        compressed_residual, descriptors, self.qp_list = [], [], []
+        frame_bitrate = 0
+        self.per_row_bit = []
+        if self.config.is_firstpass:
+            self.vbs_token = []
+            self.mv_list = []
+        for slice_residual, slice_descriptors, qp_list, slice_bitrate, per_row_bit, vbs_token, mv_list in results:
+            compressed_residual += slice_residual
+            descriptors += slice_descriptors
+            self.qp_list += qp_list
+            frame_bitrate += slice_bitrate
+            self.per_row_bit += per_row_bit
+            if self.config.is_firstpass:
+                self.vbs_token += vbs_token
+                self.mv_list += mv_list
 
         compressed_descriptors, descriptors_bitrate = self.compress_descriptors(descriptors)
         self.bitrate += frame_bitrate
         self.frame_bitrate = frame_bitrate
+        if self.config.FastME and self.config.FastME_METHOD == "epzs":
+            self.colocated_mvs = self.get_colocated_mvs(descriptors, len(compressed_residual))
         compressed_data = (compressed_residual, compressed_descriptors, self.qp_list, self.frame_seq)
         decoded_frame = frame_encoder.inter_decoder.frame.to_reference_frame()
+        if self.config.ChromaEnable:
+            compressed_data += (self.process_chroma(frame, decoded_frame, descriptors, len(compressed_residual)),)
         self.frame_processed(decoded_frame)
         return compressed_data
 
-    def process_i_frame(self, frame: ReferenceFrame):
-        compressed_residual = []
-        descriptors = []
-        frame_bitrate = 0
-        self.qp_list = []
-        frame_encoder = IntraFrameEncoder(self.height, self.width, self.config, frame.data)
-        self.bitrate_controller.refresh_frame()
-        self.per_row_bit = []
-        row_bit = 0
-        if self.config.is_firstpass:
-            self.vbs_token = []
+    def get_slice_encoder(self):
+        # copy of the encoder for the slice workers, they never use the first pass or chroma
+        encoder = copy.copy(self)
+        encoder.firstpass_encoder = None
+        encoder.chroma_encoder = None
+        encoder.previous_frames = self.get_slice_references()
+        return encoder
+
+    def get_colocated_mvs(self, descriptors, residual_count):
+        # mv of every block of this P frame, the first sub-block's for a split block
+        layout, predictions = self.get_block_predictions(descriptors, self.qp_list, residual_count)
+        padded_height, _ = YuvFrame.get_padded_size(self.height, self.width, self.config.block_size)
+        mvs = np.zeros((padded_height // self.config.block_size, self.row_block_num, 2))
+        for (block_seq, sub_block_seq, _, _), (_, row_mv, col_mv) in zip(layout, predictions):
+            if sub_block_seq == 0:
+                mvs[block_seq // self.row_block_num, block_seq % self.row_block_num] = row_mv, col_mv
+        return mvs
+
+    def process_i_blocks(self, frame: ReferenceFrame, frame_encoder: IntraFrameEncoder):
+        # block by block, rate control sees the bits of every block before the next row qp is chosen
         for block_seq, block in enumerate(frame.get_blocks()):
             if block_seq % self.blocks_per_row == 0:
                 qp = self.bitrate_controller.get_qp(is_i_frame=True)
@@ -320,6 +670,8 @@ class VideoEncoder(VideoCoder):
                     use_sub_blocks = False
             if self.config.VBSEnable:
                 if use_sub_blocks:
+                    # keep the normal block reconstruction, the sub blocks trial overwrites it
+                    normal_snapshot = frame_encoder.intra_decoder.snapshot(block_seq)
                     (
                         sub_blocks_residual,
                         sub_blocks_descriptors,
@@ -328,24 +680,61 @@ class VideoEncoder(VideoCoder):
                     ) = frame_encoder.process(block, block_seq, use_sub_blocks=True, qp=qp)
                     sub_blocks_bitrate = sub_blocks_residual_bitrate + len(sub_blocks_descriptors)
                     use_sub_blocks = self.calculate_RDO(normal_bitrate, normal_distortion) > self.calculate_RDO(sub_blocks_bitrate, sub_blocks_distortion)
-                    # roll back normal block status
-                if not use_sub_blocks:
-                    _ = frame_encoder.process(block, block_seq, use_sub_blocks=False, qp=qp)
+                    if not use_sub_blocks:
+                        # roll back normal block status
+                        frame_encoder.intra_decoder.rollback(normal_snapshot)
             else:
                 use_sub_blocks = False
-            block_bitrate = 0
             if use_sub_blocks:
-                compressed_residual += sub_blocks_residual
-                descriptors += sub_blocks_descriptors
-                descriptor_bitrate = self.cal_entrophy_bitcount(sub_blocks_descriptors)
-                block_bitrate = sub_blocks_residual_bitrate + descriptor_bitrate
-                frame_bitrate += block_bitrate
+                yield use_sub_blocks, sub_blocks_residual, sub_blocks_descriptors, sub_blocks_residual_bitrate
             else:
-                compressed_residual += normal_residual
-                descriptors += normal_descriptors
-                descriptor_bitrate = self.cal_entrophy_bitcount(normal_descriptors)
-                block_bitrate = normal_residual_bitrate + descriptor_bitrate
-                frame_bitrate += block_bitrate
+                yield use_sub_blocks, normal_residual, normal_descriptors, normal_residual_bitrate
+
+    def process_i_blocks_wavefront(self, frame: ReferenceFrame, frame_encoder: IntraFrameEncoder):
+        # without rate control every row qp is known up front
+        block_count = frame.height // self.config.block_size * self.row_block_num
+        qps = []
+        for block_seq in range(block_count):
+            if block_seq % self.blocks_per_row == 0:
+                qp = self.bitrate_controller.get_qp(is_i_frame=True)
+                self.qp_list.append(qp)
+                self.bitrate_controller.update_used_rows()
+            qps.append(qp)
+        return frame_encoder.process_wavefront(frame, qps, self.calculate_RDO)
+
+    def process_i_frame(self, frame: ReferenceFrame):
+        compressed_residual = []
+        descriptors = []
+        frame_bitrate = 0
+        self.qp_list = []
+        frame_encoder = IntraFrameEncoder(self.height, self.width, self.config, frame.data)
+        self.colocated_mvs = None
+        self.motion_tables = None
+        self.attach_stats(frame_encoder, frame_encoder.intra_decoder)
+        self.bitrate_controller.refresh_frame(is_i_frame=True)
+        self.per_row_bit = []
+        row_bit = 0
+        if self.config.is_firstpass:
+            self.vbs_token = []
+        if self.config.RCflag == 0 and not self.config.need_display:
+            blocks = self.process_i_blocks_wavefront(frame, frame_encoder)
+        else:
+            blocks = self.process_i_blocks(frame, frame_encoder)
+        for block_seq, (use_sub_blocks, block_residual, block_descriptors, residual_bitrate) in enumerate(blocks):
+            compressed_residual += block_residual
+            descriptors += block_descriptors
+            descriptor_bitrate = self.cal_entrophy_bitcount(block_descriptors)
+            block_bitrate = residual_bitrate + descriptor_bitrate
+            frame_bitrate += block_bitrate
+            if self.stats is not None:
+                self.stats.count_block(
+                    residual_bitrate,
+                    descriptor_bitrate,
+                    block_descriptors,
+                    False,
+                    self.config.VBSEnable and (self.config.RCflag != 3 or self.vbs_token[block_seq]),
+                    use_sub_blocks,
+                )
             if self.config.RCflag > 0:
                 self.bitrate_controller.use_bit_count_for_a_frame(block_bitrate)
             if self.config.is_firstpass:
@@ -359,29 +748,59 @@ class VideoEncoder(VideoCoder):
         self.frame_bitrate = frame_bitrate
         compressed_data = (compressed_residual, compressed_descriptors, self.qp_list, self.frame_seq)
         decoded_frame = frame_encoder.intra_decoder.frame.to_reference_frame()
+        if self.config.ChromaEnable:
+            compressed_data += (self.process_chroma(frame, decoded_frame, descriptors, len(compressed_residual)),)
         self.frame_processed(decoded_frame)
         return compressed_data
 
+    @timed("first_pass")
+    def process_first_pass(self, frame: ReferenceFrame):
+        if self.frame_seq:
+            self.firstpass_encoder.config.qp = sum(self.qp_list) // len(self.qp_list)
+        self.firstpass_encoder.frame_seq = self.frame_seq
+        self.firstpass_encoder.process(frame)
+        first_pass_bit = self.firstpass_encoder.frame_bitrate
+        self.bitrate_controller.set_row_ratio(self.firstpass_encoder.per_row_bit)
+        if self.firstpass_encoder.frame_seq == 1:
+            self.bitrate_controller.update_itable(self.firstpass_encoder.config.qp, first_pass_bit)
+        else:
+            self.bitrate_controller.update_ptable(self.firstpass_encoder.config.qp, first_pass_bit)
+        if self.is_p_frame():
+            if first_pass_bit > self.bitrate_controller.threshold_dic[self.firstpass_encoder.config.qp]:
+                self.frame_seq = self.config.i_Period
+        if self.config.RCflag == 3:
+            self.vbs_token = self.firstpass_encoder.vbs_token
+            self.mv_list = self.firstpass_encoder.mv_list
+        self.seed_tables = None
+        if not self.config.RCSecondPassSearch:
+            self.seed_tables = self.firstpass_encoder.motion_tables
+
     def process(self, frame: ReferenceFrame):
         'if the rc == 2, we need to pre-execute the encoding first and the determine if is i_frame or p_frame'
+        if self.stats is not None:
+            self.stats.start_frame()
         if self.config.RCflag > 1:
-            if self.frame_seq:
-                self.firstpass_encoder.config.qp = sum(self.qp_list) // len(self.qp_list)
-            self.firstpass_encoder.frame_seq = self.frame_seq
-            self.firstpass_encoder.process(frame)
-            first_pass_bit = self.firstpass_encoder.frame_bitrate
-            self.bitrate_controller.set_row_ratio(self.firstpass_encoder.per_row_bit)
-            if self.firstpass_encoder.frame_seq == 1:
-                self.bitrate_controller.update_itable(self.firstpass_encoder.config.qp, first_pass_bit)
-            else:
-                self.bitrate_controller.update_ptable(self.firstpass_encoder.config.qp, first_pass_bit)
-            if self.is_p_frame():
-                if first_pass_bit > self.bitrate_controller.threshold_dic[self.firstpass_encoder.config.qp]:
-                    self.frame_seq = self.config.i_Period
-            if self.config.RCflag == 3:
-                self.vbs_token = self.firstpass_encoder.vbs_token
-                self.mv_list = self.firstpass_encoder.mv_list
+            self.process_first_pass(frame)
         if self.is_i_frame():
-            return self.process_i_frame(frame)
+            compressed_data = self.process_i_frame(frame)
         else:
-            return self.process_p_frame(frame)
+            compressed_data = self.process_p_frame(frame)
+        if self.stats is not None:
+            self.stats.end_frame(compressed_data[3], self.is_p_frame(compressed_data[3]), self.qp_list)
+        return compressed_data
+
+
+def encode_p_slice(encoder: VideoEncoder, frame_rows, frame_shape, first_row, motion_field, colocated_mvs, first_block, stop_block):
+    # runs in a worker on the rows of a slice, the same rows of the reconstruction and the slice statistics
+    # go back with the result
+    data = np.zeros(frame_shape, dtype=np.uint8)
+    data[first_row : first_row + len(frame_rows)] = frame_rows
+    frame_encoder = InterFrameEncoder(encoder.height, encoder.width, encoder.previous_frames, encoder.config)
+    frame_encoder.motion_field = motion_field
+    frame_encoder.colocated_mvs = colocated_mvs
+    encoder.attach_stats(frame_encoder, frame_encoder.inter_decoder)
+    if encoder.stats is not None:
+        encoder.stats.start_frame()
+    result = encoder.process_p_slice(ReferenceFrame(encoder.config, data), frame_encoder, first_block, stop_block)
+    slice_stats = encoder.stats.frame if encoder.stats is not None else None
+    return result, frame_encoder.inter_decoder.frame.data[first_row : first_row + len(frame_rows)], slice_stats
@@ -0,0 +1,116 @@
+import numpy as np
+from functools import cache
+
+# codewords are read through 64 bit windows that start on a byte boundary
+MAX_CODE_LENGTH = 57
+WINDOW_OFFSETS = np.arange(8)
+TABLE_MAX_SYMBOL = 4096
+
+
+class ExpGolombBuffer:
+    """
+    Packed signed Exp-Golomb codewords, the same bits bitstring writes for se=.
+    length is the number of meaningful bits, the last byte is zero padded.
+    """
+    def __init__(self, data: bytes, length: int) -> None:
+        self.data = data
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __eq__(self, other):
+        return isinstance(other, ExpGolombBuffer) and self.length == other.length and self.data == other.data
+
+
+def to_code_numbers(symbols: np.ndarray) -> np.ndarray:
+    # se mapping: 0, 1, -1, 2, -2, ... -> 0, 1, 2, 3, 4, ...
+    symbols = np.asarray(symbols).astype(np.int64)
+    return np.where(symbols > 0, 2 * symbols - 1, -2 * symbols).astype(np.uint64)
+
+
+def get_code_lengths(symbols) -> np.ndarray:
+    # a codeword of code number n is n + 1 written on 2 * bit_length(n + 1) - 1 bits
+    values = to_code_numbers(symbols) + 1
+    return 2 * np.frexp(values.astype(np.float64))[1].astype(np.int64) - 1
+
+
+def get_code_length(symbol) -> int:
+    symbol = int(symbol)
+    return 2 * (2 * abs(symbol) + (symbol <= 0)).bit_length() - 1
+
+
+@cache
+def get_length_table(max_symbol: int) -> np.ndarray:
+    # code lengths of -max_symbol .. max_symbol, indexed by symbol + max_symbol
+    return get_code_lengths(np.arange(-max_symbol, max_symbol + 1))
+
+
+def get_symbol_lengths(symbols) -> np.ndarray:
+    # table lookup for the usual small symbols, computed otherwise
+    symbols = np.asarray(symbols).astype(np.int64)
+    if symbols.size and np.abs(symbols).max() > TABLE_MAX_SYMBOL:
+        return get_code_lengths(symbols)
+    return get_length_table(TABLE_MAX_SYMBOL)[symbols + TABLE_MAX_SYMBOL]
+
+
+def encode(symbols) -> ExpGolombBuffer:
+    values = to_code_numbers(symbols) + 1
+    lengths = get_code_lengths(symbols)
+    if len(values) and lengths.max() > MAX_CODE_LENGTH:
+        raise Exception(f"Error! Symbol out of the Exp-Golomb range, code length {lengths.max()}")
+    total_length = int(lengths.sum())
+    # every bit knows its codeword and its distance to the end of it
+    codeword = np.repeat(np.arange(len(values)), lengths)
+    ends = np.cumsum(lengths)
+    shifts = (np.repeat(ends, lengths) - 1 - np.arange(total_length)).astype(np.uint64)
+    bits = ((values[codeword] >> shifts) & np.uint64(1)).astype(np.uint8)
+    return ExpGolombBuffer(np.packbits(bits).tobytes(), total_length)
+
+
+def decode(buffer: ExpGolombBuffer) -> np.ndarray:
+    length = buffer.length
+    if length == 0:
+        return np.zeros(0, dtype=np.int64)
+    # one bit past the end is set, so every position has a following one
+    bits = np.unpackbits(np.frombuffer(buffer.data, dtype=np.uint8), count=length + 1)
+    bits[length] = 1
+    positions = np.arange(length + 1)
+    next_ones = np.minimum.accumulate(np.where(bits, positions, length)[::-1])[::-1]
+    # a codeword read at any position ends after twice its leading zero count plus one bits
+    jumps = np.minimum(2 * next_ones - positions + 1, length)
+    # codeword starts are the positions chained from 0 through the jumps, found by pointer doubling:
+    # after k rounds starts holds the first 2 ** k codewords and jumps skips 2 ** k codewords
+    starts = np.zeros(1, dtype=np.int64)
+    while jumps[0] < length:
+        starts = np.concatenate((starts, jumps[starts]))
+        jumps = jumps[jumps]
+    starts = starts[starts < length]
+    last = int(starts[-1])
+    if 2 * int(next_ones[last]) - last + 1 != length:
+        raise Exception("Error! Truncated Exp-Golomb codeword")
+    leading_zeros = next_ones[starts] - starts
+    # big endian 64 bit window at the byte of every start
+    padded = np.frombuffer(buffer.data + bytes(8), dtype=np.uint8)
+    windows = padded[(starts >> 3)[:, np.newaxis] + WINDOW_OFFSETS].view(">u8")[:, 0].astype(np.uint64)
+    windows = windows << (starts & 7).astype(np.uint64)
+    values = windows >> (63 - 2 * leading_zeros).astype(np.uint64)
+    values = values.astype(np.int64)
+    # inverse se mapping, odd values are the non positive symbols
+    return np.where(values & 1, -(values >> 1), values >> 1)
+
+
+def concatenate(buffers) -> ExpGolombBuffer:
+    # bit level concatenation, no padding between buffers
+    bits = [np.unpackbits(np.frombuffer(buffer.data, dtype=np.uint8))[: buffer.length] for buffer in buffers]
+    bits = np.concatenate(bits) if bits else np.zeros(0, dtype=np.uint8)
+    return ExpGolombBuffer(np.packbits(bits).tobytes(), len(bits))
+
+
+def split(buffer: ExpGolombBuffer, lengths):
+    bits = np.unpackbits(np.frombuffer(buffer.data, dtype=np.uint8))
+    ends = np.cumsum(lengths)
+    return [
+        ExpGolombBuffer(np.packbits(bits[end - length : end]).tobytes(), int(length))
+        for length, end in zip(lengths, ends)
+    ]
@@ -6,17 +6,60 @@ from PixelPerfect.CodecConfig import CodecConfig
 import numpy as np
 import json
 
-def read_frames(source_path, height, width, config: CodecConfig):
-    height = height
-    width = width
-    yuv_frame_size = width * height + (width // 2) * (height // 2) * 2
-    y_frame_size = width * height
-    
-    for yuv_frame_data in read_video(source_path, yuv_frame_size):
-        yield ReferenceFrame(
-            config,
-            data=np.frombuffer(yuv_frame_data[:y_frame_size], dtype=np.uint8).reshape((height, width)),
-        )
+class YuvFile:
+    """
+    Raw 4:2:0 video mapped in memory instead of read. Planes are views into the file, only the
+    frames that are used get loaded, whatever their position in the file.
+    """
+    def __init__(self, path, height, width) -> None:
+        self.height = height
+        self.width = width
+        self.y_frame_size = width * height
+        self.uv_frame_size = (width // 2) * (height // 2)
+        self.frame_size = self.y_frame_size + self.uv_frame_size * 2
+        data = np.memmap(path, dtype=np.uint8, mode="r")
+        # a truncated last frame is ignored, like a short read
+        frame_count = len(data) // self.frame_size
+        self.frames = np.asarray(data[: frame_count * self.frame_size]).reshape(frame_count, self.frame_size)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def get_planes(self, frames):
+        # frames is a frame index or a slice, several frames come as stacks of planes
+        data = self.frames[frames]
+        shape = data.shape[:-1]
+        y = data[..., : self.y_frame_size].reshape(*shape, self.height, self.width)
+        u = data[..., self.y_frame_size : self.y_frame_size + self.uv_frame_size].reshape(*shape, self.height // 2, self.width // 2)
+        v = data[..., self.y_frame_size + self.uv_frame_size :].reshape(*shape, self.height // 2, self.width // 2)
+        return y, u, v
+
+    def get_y_planes(self, start=0, stop=None, step=1):
+        return self.get_planes(slice(start, stop, step))[0]
+
+
+def read_frames(source_path, height, width, config: CodecConfig, start=0, stop=None, step=1):
+    if not config.ChromaEnable:
+        for y in YuvFile(source_path, height, width).get_y_planes(start, stop, step):
+            yield ReferenceFrame(config, data=y)
+        return
+    chroma_config = config.get_chroma_config()
+    for y, u, v in zip(*YuvFile(source_path, height, width).get_planes(slice(start, stop, step))):
+        frame = ReferenceFrame(config, data=y)
+        frame.chroma = [ReferenceFrame(chroma_config, data=u), ReferenceFrame(chroma_config, data=v)]
+        yield frame
+
+
+def write_frames(path, frames, height, width):
+    # frames without chroma are written with gray U and V
+    with open(path, "wb") as file:
+        for frame in frames:
+            file.write(np.ascontiguousarray(frame.data[:height, :width]).tobytes())
+            for plane in range(2):
+                if frame.chroma is None:
+                    file.write(np.full((height // 2, width // 2), 128, dtype=np.uint8).tobytes())
+                else:
+                    file.write(np.ascontiguousarray(frame.chroma[plane].data[: height // 2, : width // 2]).tobytes())
 
 def read_video(path, size):
     with open(path, "rb") as file:
@@ -50,7 +93,7 @@ def read_json(filename) -> dict:
 def dump(data):
     id = uuid.uuid4().hex
     with open(dataId2filename(id), "wb") as file:
-        pickle.dump(data, file, indent=4)
+        pickle.dump(data, file)
     return id
 
 
@@ -0,0 +1,464 @@
+import copy
+import math
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from PixelPerfect.Yuv import YuvBlock, ReferenceFrame
+from PixelPerfect.CodecConfig import CodecConfig
+from typing import Deque
+
+# windows of at least this many candidates are searched with successive elimination
+PRUNED_SEARCH_MIN_CANDIDATES = 400
+# candidates scored between two updates of the best SADs of the blocks
+PRUNED_SEARCH_CHUNK = 32
+
+
+def is_better_tied_mv(row_mv, col_mv, best_row_mv, best_col_mv) -> bool:
+    # candidates with equal mae and equal distance: prefer the smaller -row_mv, then the smaller -col_mv
+    if -row_mv != best_row_mv:
+        return -row_mv < best_row_mv
+    return -col_mv < best_col_mv
+
+
+def get_closest_best_candidates(sads: np.ndarray, row_mvs: np.ndarray, col_mvs: np.ndarray):
+    # sads has one row per candidate (in search order) and one column per block
+    min_sads = sads.min(axis=0)
+    distances = np.where(
+        sads == min_sads,
+        (np.abs(row_mvs) + np.abs(col_mvs)).astype(np.int32)[:, np.newaxis],
+        np.iinfo(np.int32).max,
+    )
+    min_distances = distances.min(axis=0)
+    return min_sads, min_distances, distances == min_distances
+
+
+def select_best_candidates(frame_candidates, row_mvs: np.ndarray, col_mvs: np.ndarray):
+    """
+    frame_candidates holds the get_closest_best_candidates result of every reference frame,
+    in search order. The best candidate has the minimum mae, then the minimum distance, and the
+    remaining ties are resolved in search order exactly like a sequential full search would.
+    """
+    min_sads = np.stack([candidates[0] for candidates in frame_candidates])
+    min_distances = np.stack([candidates[1] for candidates in frame_candidates])
+    best_sads = min_sads.min(axis=0)
+    min_distances = np.where(min_sads == best_sads, min_distances, np.iinfo(np.int32).max)
+    best_distances = min_distances.min(axis=0)
+    is_best = np.stack([
+        is_closest & (min_distance == best_distances)
+        for (_, _, is_closest), min_distance in zip(frame_candidates, min_distances)
+    ])
+    candidates_per_frame = len(row_mvs)
+    is_best = is_best.reshape(-1, is_best.shape[-1])
+    best = is_best.argmax(axis=0)
+    for block_seq in np.flatnonzero(is_best.sum(axis=0) > 1):
+        for candidate in np.flatnonzero(is_best[:, block_seq]):
+            best_candidate = best[block_seq] % candidates_per_frame
+            if is_better_tied_mv(
+                row_mvs[candidate % candidates_per_frame],
+                col_mvs[candidate % candidates_per_frame],
+                row_mvs[best_candidate],
+                col_mvs[best_candidate],
+            ):
+                best[block_seq] = candidate
+    return best // candidates_per_frame, best % candidates_per_frame, best_sads
+
+
+class MotionField:
+    """
+    Full search of every block (and every VBS sub-block) of a frame, done in one batched pass
+    before the block loop. Candidates are scored one displacement at a time over the whole
+    frame, which turns thousands of small searches into a few large array operations. With
+    FMEEnable the best integer mv is then refined on its eight half-pel neighbours, unless
+    FMEFullSearch asks for every half-pel candidate of the window. Large windows skip the
+    candidates that successive elimination proves worse than the best SAD of a block.
+    """
+    # pixel row of the first table row, see get_rows
+    first_row = 0
+    # block SADs successive elimination did not have to score
+    skipped_count = 0
+
+    def __init__(self, config: CodecConfig, frame: ReferenceFrame, previous_frames: Deque[ReferenceFrame]) -> None:
+        self.config = config
+        # the window is searched in FME_frame units for a half-pel search
+        self.scale = 2 if self.config.FMEEnable and self.config.FMEFullSearch else 1
+        offset = self.config.block_search_offset * self.scale
+        # every mv of the window, before clamping to the frame, the half-pel columns reach 2 * offset to the left
+        if self.scale == 2:
+            row_mvs, col_mvs = np.meshgrid(np.arange(-offset, offset + 1), np.arange(-2 * offset, offset + 1), indexing="ij")
+        else:
+            row_mvs, col_mvs = np.meshgrid(np.arange(-offset, offset + 1), np.arange(-offset, offset + 1), indexing="ij")
+        self.row_mvs, self.col_mvs = row_mvs.ravel(), col_mvs.ravel()
+        block_sizes = [self.config.block_size]
+        if self.config.VBSEnable:
+            block_sizes.append(self.config.sub_block_size)
+        self.tables = dict()
+        # block SADs scored, of every block and sub-block against every reference
+        self.sad_count = 0
+        # best SAD of every block over the references searched so far
+        best_sads = {
+            block_size: np.full((frame.height // block_size, frame.width // block_size), np.iinfo(np.int32).max, dtype=np.int32)
+            for block_size in block_sizes
+        }
+        frame_candidates = {block_size: [None] * len(previous_frames) for block_size in block_sizes}
+        # the latest reference usually matches best, searched first it prunes the others the most
+        for frame_seq in reversed(range(len(previous_frames))):
+            # the bound of a single pixel is its SAD
+            if len(self.row_mvs) < PRUNED_SEARCH_MIN_CANDIDATES or min(block_sizes) == 1:
+                sads = self.get_SADs(frame, previous_frames[frame_seq], block_sizes)
+            else:
+                sads = self.get_pruned_SADs(frame, previous_frames[frame_seq], block_sizes, best_sads)
+            for block_size in block_sizes:
+                sad = sads[block_size].reshape(len(self.row_mvs), -1)
+                frame_candidates[block_size][frame_seq] = get_closest_best_candidates(sad, self.row_mvs, self.col_mvs)
+        if self.config.FMEEnable and self.scale == 1:
+            planes = np.stack([ref_frame.signed_FME_frame for ref_frame in previous_frames])
+        for block_size in block_sizes:
+            frame_seq, candidate, sad = select_best_candidates(frame_candidates[block_size], self.row_mvs, self.col_mvs)
+            shape = (frame.height // block_size, frame.width // block_size)
+            mvs = np.stack([self.row_mvs[candidate], self.col_mvs[candidate]], axis=-1).reshape(shape + (2,))
+            frame_seq, sad = frame_seq.reshape(shape), sad.reshape(shape).astype(np.int64)
+            if self.config.FMEEnable and self.scale == 1:
+                mvs, sad = self.refine_half_pel(frame.signed_data, planes, frame_seq, block_size, mvs, sad)
+            self.tables[block_size] = (frame_seq, mvs[..., 0], mvs[..., 1], sad)
+
+    def get_SADs(self, frame: ReferenceFrame, ref_frame: ReferenceFrame, block_sizes):
+        plane = ref_frame.signed_FME_frame if self.scale == 2 else ref_frame.signed_data
+        ref_frame_shape = plane.shape
+        row_margin, col_margin = np.abs(self.row_mvs).max(), np.abs(self.col_mvs).max()
+        plane = np.pad(plane, ((row_margin, row_margin), (col_margin, col_margin)))
+        # candidates read every other pixel of FME_frame, keep each phase contiguous
+        phases = [
+            [np.ascontiguousarray(plane[row_phase :: self.scale, col_phase :: self.scale]) for col_phase in range(self.scale)]
+            for row_phase in range(self.scale)
+        ]
+        current = frame.signed_data
+        height, width = current.shape
+        sads = {block_size: [] for block_size in block_sizes}
+        for row_mv, col_mv in zip(self.row_mvs, self.col_mvs):
+            row_phase, row = divmod(row_margin + row_mv, self.scale)[::-1]
+            col_phase, col = divmod(col_margin + col_mv, self.scale)[::-1]
+            shifted = phases[row_phase][col_phase][row : row + height, col : col + width]
+            diff = np.abs(current - shifted)
+            for block_size in sorted(block_sizes):
+                if block_size == min(block_sizes):
+                    sad = diff.reshape(height // block_size, block_size, width).sum(axis=1, dtype=np.int32)
+                    sad = sad.reshape(height // block_size, width // block_size, block_size).sum(axis=2)
+                else:
+                    # a block is the sum of its four sub-blocks
+                    sad = sad.reshape(height // block_size, 2, width // block_size, 2).sum(axis=(1, 3))
+                sads[block_size].append(sad)
+        for block_size in block_sizes:
+            sad = np.stack(sads[block_size])
+            self.sad_count += sad.size
+            # candidates outside of the reference frame are never picked
+            is_valid = self.get_valid_candidates(current.shape, ref_frame_shape, block_size)
+            sads[block_size] = np.where(is_valid, sad, np.iinfo(np.int32).max)
+        return sads
+
+    def get_valid_candidates(self, shape, plane_shape, block_size):
+        # (candidates, block rows, block cols) mask of the candidates inside of the reference plane
+        positions = np.arange(0, shape[0], block_size) * self.scale
+        candidate_rows = positions[np.newaxis, :] + self.row_mvs[:, np.newaxis]
+        is_valid_row = (candidate_rows >= 0) & (candidate_rows <= plane_shape[0] - block_size * self.scale)
+        positions = np.arange(0, shape[1], block_size) * self.scale
+        candidate_cols = positions[np.newaxis, :] + self.col_mvs[:, np.newaxis]
+        is_valid_col = (candidate_cols >= 0) & (candidate_cols <= plane_shape[1] - block_size * self.scale)
+        return is_valid_row[:, :, np.newaxis] & is_valid_col[:, np.newaxis, :]
+
+    @staticmethod
+    def get_group_sums(plane: np.ndarray, size):
+        # sums of the size x size groups of the last two axes, strided adds beat small axis sums
+        plane = sum(plane[..., col :: size] for col in range(size))
+        return sum(plane[..., row :: size, :] for row in range(size))
+
+    def get_pruned_SADs(self, frame: ReferenceFrame, ref_frame: ReferenceFrame, block_sizes, best_sads):
+        """
+        get_SADs with successive elimination. Frames are cut into cells of 4x4 pixels, and the sum
+        over the cells of a block of |sum(current cell) - sum(candidate cell)| is a lower bound of
+        its SAD. Candidates are taken by distance to the zero mv, PRUNED_SEARCH_CHUNK at a time,
+        and a block is only scored when its bound is not above its best SAD so far; sub-blocks
+        are scored with their block, or alone when only their own bound passes. best_sads holds
+        the best SADs of the references before and is updated. Only candidates strictly above
+        the best are dropped, so the minimum and all its ties are kept, the others get the int32
+        maximum like the candidates outside of the reference frame.
+        """
+        plane = ref_frame.signed_FME_frame if self.scale == 2 else ref_frame.signed_data
+        ref_frame_shape = plane.shape
+        row_margin, col_margin = np.abs(self.row_mvs).max(), np.abs(self.col_mvs).max()
+        plane = np.pad(plane, ((row_margin, row_margin), (col_margin, col_margin)))
+        # every phase of FME_frame as a plane of its own, the first one is the largest
+        phases = [plane[row_phase :: self.scale, col_phase :: self.scale] for row_phase in range(self.scale) for col_phase in range(self.scale)]
+        phase_height, phase_width = phases[0].shape
+        phases = np.stack([np.pad(phase, ((0, phase_height - phase.shape[0]), (0, phase_width - phase.shape[1]))) for phase in phases])
+        row_phases, rows = (row_margin + self.row_mvs) % self.scale, (row_margin + self.row_mvs) // self.scale
+        col_phases, cols = (col_margin + self.col_mvs) % self.scale, (col_margin + self.col_mvs) // self.scale
+        candidate_phases = row_phases * self.scale + col_phases
+        current = frame.signed_data
+        height, width = current.shape
+        block_size, sub_block_size = max(block_sizes), min(block_sizes)
+        cell = math.gcd(4, sub_block_size)
+        # sums of every cell of the phases, split by position modulo cell so that the cells of a
+        # candidate are a window of one of the grids
+        integral = np.zeros((len(phases), phase_height + 1, phase_width + 1), dtype=np.int32)
+        integral[:, 1:, 1:] = phases.cumsum(axis=1, dtype=np.int32).cumsum(axis=2)
+        cell_sums = integral[:, cell:, cell:] - integral[:, :-cell, cell:] - integral[:, cell:, :-cell] + integral[:, :-cell, :-cell]
+        grids = np.zeros((len(phases), cell, cell, -(-cell_sums.shape[1] // cell), -(-cell_sums.shape[2] // cell)), dtype=np.int32)
+        for row_offset in range(cell):
+            for col_offset in range(cell):
+                grid = cell_sums[:, row_offset::cell, col_offset::cell]
+                grids[:, row_offset, col_offset, : grid.shape[1], : grid.shape[2]] = grid
+        grid_windows = sliding_window_view(grids, (height // cell, width // cell), axis=(3, 4))
+        current_cells = self.get_group_sums(current.astype(np.int32), cell)
+        windows = {size: sliding_window_view(phases, (size, size), axis=(1, 2)) for size in block_sizes}
+        current_blocks = {size: self.get_blocks(current, size) for size in block_sizes}
+        is_valid = {size: self.get_valid_candidates(current.shape, ref_frame_shape, size) for size in block_sizes}
+        sads = {size: np.full(is_valid[size].shape, np.iinfo(np.int32).max, dtype=np.int32) for size in block_sizes}
+        def get_differences(size, displacements, block_rows, block_cols):
+            # |current - candidate| of the blocks of size at block_rows and block_cols, one per displacement
+            phase_rows, phase_cols = rows[displacements] + block_rows * size, cols[displacements] + block_cols * size
+            differences = windows[size][candidate_phases[displacements], phase_rows, phase_cols]
+            differences -= current_blocks[size][block_rows, block_cols]
+            return np.abs(differences, out=differences)
+
+        order = np.argsort(np.abs(self.row_mvs) + np.abs(self.col_mvs), kind="stable")
+        sad_count = 0
+        for start in range(0, len(order), PRUNED_SEARCH_CHUNK):
+            candidates = order[start : start + PRUNED_SEARCH_CHUNK]
+            candidate_rows, candidate_cols = rows[candidates], cols[candidates]
+            cells = grid_windows[candidate_phases[candidates], candidate_rows % cell, candidate_cols % cell, candidate_rows // cell, candidate_cols // cell]
+            bounds = {sub_block_size: self.get_group_sums(np.abs(cells - current_cells), sub_block_size // cell)}
+            bounds[block_size] = self.get_group_sums(bounds[sub_block_size], block_size // sub_block_size)
+            is_scored = {size: is_valid[size][candidates] & (bounds[size] <= best_sads[size]) for size in block_sizes}
+            chunk_sads = {size: np.full(is_scored[size].shape, np.iinfo(np.int32).max, dtype=np.int32) for size in block_sizes}
+            seqs, block_rows, block_cols = np.nonzero(is_scored[block_size])
+            diff = get_differences(block_size, candidates[seqs], block_rows, block_cols)
+            sad_count += len(seqs)
+            if block_size == sub_block_size:
+                chunk_sads[block_size][seqs, block_rows, block_cols] = diff.sum(axis=(1, 2), dtype=np.int32)
+            else:
+                # a block is the sum of its four sub-blocks
+                block_sads = 0
+                for row_half in range(2):
+                    for col_half in range(2):
+                        sub_block_diff = diff[
+                            :,
+                            row_half * sub_block_size : (row_half + 1) * sub_block_size,
+                            col_half * sub_block_size : (col_half + 1) * sub_block_size,
+                        ]
+                        sub_block_sads = sub_block_diff.sum(axis=(1, 2), dtype=np.int32)
+                        chunk_sads[sub_block_size][seqs, 2 * block_rows + row_half, 2 * block_cols + col_half] = sub_block_sads
+                        block_sads = block_sads + sub_block_sads
+                chunk_sads[block_size][seqs, block_rows, block_cols] = block_sads
+                sad_count += 4 * len(seqs)
+                # sub-blocks whose block was dropped are scored alone
+                is_alone = is_scored[sub_block_size] & ~is_scored[block_size].repeat(2, axis=1).repeat(2, axis=2)
+                seqs, sub_block_rows, sub_block_cols = np.nonzero(is_alone)
+                diff = get_differences(sub_block_size, candidates[seqs], sub_block_rows, sub_block_cols)
+                chunk_sads[sub_block_size][seqs, sub_block_rows, sub_block_cols] = diff.sum(axis=(1, 2), dtype=np.int32)
+                sad_count += len(seqs)
+            for size in block_sizes:
+                chunk_sads[size] = np.where(is_valid[size][candidates], chunk_sads[size], np.iinfo(np.int32).max)
+                sads[size][candidates] = chunk_sads[size]
+                best_sads[size] = np.minimum(best_sads[size], chunk_sads[size].min(axis=0))
+        self.sad_count += sad_count
+        self.skipped_count += sum(sad.size for sad in sads.values()) - sad_count
+        return sads
+
+    @staticmethod
+    def get_blocks(plane: np.ndarray, block_size):
+        # (block rows, block cols, block_size, block_size) view of the blocks of a plane
+        height, width = plane.shape
+        return plane.reshape(height // block_size, block_size, width // block_size, block_size).swapaxes(1, 2)
+
+    @staticmethod
+    def is_better(sads, mvs, best_sads, best_mvs):
+        # lower SAD, then the mv closest to zero
+        distances, best_distances = np.abs(mvs).sum(axis=-1), np.abs(best_mvs).sum(axis=-1)
+        return (sads < best_sads) | ((sads == best_sads) & (distances < best_distances))
+
+    def get_block_SADs(self, blocks: np.ndarray, plane: np.ndarray, rows, cols, step=1, frame_seqs=None):
+        # SADs of blocks against the blocks of plane at rows and cols, reading every step pixels,
+        # plane holds one plane per reference frame when frame_seqs is given
+        offsets = step * np.arange(blocks.shape[-1])
+        index = (rows[..., np.newaxis, np.newaxis] + offsets[:, np.newaxis], cols[..., np.newaxis, np.newaxis] + offsets)
+        if frame_seqs is not None:
+            index = (frame_seqs[..., np.newaxis, np.newaxis],) + index
+        self.sad_count += rows.size
+        return np.abs(plane[index] - blocks).sum(axis=(-2, -1))
+
+    def refine_half_pel(self, current: np.ndarray, planes: np.ndarray, frame_seqs: np.ndarray, block_size, mvs: np.ndarray, sads: np.ndarray):
+        # integer mvs and their SADs, returned in FME_frame units after checking the eight half-pel
+        # neighbours on the signed_FME_frame planes of the reference frames picked by frame_seqs
+        mvs = 2 * mvs
+        blocks = self.get_blocks(current, block_size)
+        rows = np.broadcast_to(np.arange(blocks.shape[0])[:, np.newaxis] * 2 * block_size, blocks.shape[:2])
+        cols = np.broadcast_to(np.arange(blocks.shape[1])[np.newaxis, :] * 2 * block_size, blocks.shape[:2])
+        best_mvs, best_sads = mvs, sads
+        limit = 2 * self.config.block_search_offset
+        for row_move in (-1, 0, 1):
+            for col_move in (-1, 0, 1):
+                if row_move == 0 and col_move == 0:
+                    continue
+                candidates = mvs + (row_move, col_move)
+                candidate_rows, candidate_cols = rows + candidates[..., 0], cols + candidates[..., 1]
+                is_valid = (
+                    (np.abs(candidates) <= limit).all(axis=-1)
+                    & (candidate_rows >= 0) & (candidate_rows <= planes.shape[1] - 2 * block_size + 1)
+                    & (candidate_cols >= 0) & (candidate_cols <= planes.shape[2] - 2 * block_size + 1)
+                )
+                candidate_sads = np.full(rows.shape, np.iinfo(np.int32).max, dtype=np.int64)
+                candidate_sads[is_valid] = self.get_block_SADs(
+                    blocks[is_valid], planes, candidate_rows[is_valid], candidate_cols[is_valid], step=2, frame_seqs=frame_seqs[is_valid]
+                )
+                is_better = self.is_better(candidate_sads, candidates, best_sads, best_mvs)
+                best_sads = np.where(is_better, candidate_sads, best_sads)
+                best_mvs = np.where(is_better[..., np.newaxis], candidates, best_mvs)
+        return best_mvs, best_sads
+
+    def get_rows(self, first_row, stop_row):
+        # the same motion field with the tables of the blocks from pixel row first_row to stop_row only
+        field = copy.copy(self)
+        field.first_row = first_row
+        field.tables = {
+            block_size: tuple(table[first_row // block_size : stop_row // block_size] for table in tables)
+            for block_size, tables in self.tables.items()
+        }
+        return field
+
+    def get_inter_data(self, block: YuvBlock):
+        frame_seqs, row_mvs, col_mvs, _ = self.tables[block.block_size]
+        block_row, block_col = (int(block.row) - self.first_row) // block.block_size, int(block.col) // block.block_size
+        frame_seq = int(frame_seqs[block_row, block_col])
+        row_mv, col_mv = int(row_mvs[block_row, block_col]), int(col_mvs[block_row, block_col])
+        if self.config.FMEEnable:
+            row_mv, col_mv = row_mv / 2, col_mv / 2
+        return row_mv, col_mv, frame_seq
+
+    def get_SAD(self, block: YuvBlock):
+        sads = self.tables[block.block_size][3]
+        return int(sads[(int(block.row) - self.first_row) // block.block_size, int(block.col) // block.block_size])
+
+
+class PyramidMotionField(MotionField):
+    """
+    Coarse to fine motion search of every block, with the tables of MotionField. Blocks are
+    searched in full on the coarsest level of the frame pyramids within block_search_offset,
+    then every finer level only checks the 3x3 candidates around the scaled mv. Sub-blocks
+    start from the mv of their block at full resolution and check a 5x5 window. With FMEEnable
+    the best integer mv is refined on the 3x3 half-pel candidates around it.
+    """
+    def __init__(self, config: CodecConfig, frame: ReferenceFrame, previous_frames: Deque[ReferenceFrame]) -> None:
+        self.config = config
+        self.scale = 2 if self.config.FMEEnable else 1
+        self.sad_count = 0
+        levels = self.config.PyramidLevels
+        current = frame.get_pyramid(levels)
+        block_size, sub_block_size = self.config.block_size, self.config.sub_block_size
+        results = {block_size: [], sub_block_size: []}
+        for ref_frame in previous_frames:
+            references = ref_frame.get_pyramid(levels)
+            mvs, sads = self.search_coarse(current[levels], references[levels], block_size >> levels)
+            for level in range(levels - 1, -1, -1):
+                mvs = self.clip_mvs(2 * mvs, self.config.block_search_offset / 2 ** level)
+                mvs, sads = self.refine(current[level], references[level], block_size >> level, mvs, 1, self.config.block_search_offset / 2 ** level)
+            results[block_size].append(self.refine_half_pel_frame(current[0], ref_frame, block_size, mvs, sads))
+            if self.config.VBSEnable:
+                # every sub-block starts from the mv of its block
+                sub_mvs = np.repeat(np.repeat(mvs, 2, axis=0), 2, axis=1)
+                sub_mvs, sub_sads = self.refine(current[0], references[0], sub_block_size, sub_mvs, 2, self.config.block_search_offset)
+                results[sub_block_size].append(self.refine_half_pel_frame(current[0], ref_frame, sub_block_size, sub_mvs, sub_sads))
+        self.tables = dict()
+        for size, frame_results in results.items():
+            if frame_results:
+                self.tables[size] = self.select_best_frame(frame_results)
+
+    @staticmethod
+    def clip_mvs(mvs: np.ndarray, limit):
+        # moving towards the zero mv keeps a candidate inside the frame
+        return np.clip(mvs, -int(limit), int(limit))
+
+    def search_coarse(self, current: np.ndarray, reference: np.ndarray, block_size):
+        # full search of every block at once, one displacement of the whole plane at a time
+        radius = -(-self.config.block_search_offset // 2 ** self.config.PyramidLevels)
+        height, width = current.shape
+        padded = np.pad(reference, radius)
+        block_rows, block_cols = np.arange(0, height, block_size), np.arange(0, width, block_size)
+        best_sads = np.full((len(block_rows), len(block_cols)), np.iinfo(np.int32).max, dtype=np.int64)
+        best_mvs = np.zeros(best_sads.shape + (2,), dtype=np.int64)
+        displacements = [(row_mv, col_mv) for row_mv in range(-radius, radius + 1) for col_mv in range(-radius, radius + 1)]
+        # closest first, so a tie keeps the closer mv
+        for row_mv, col_mv in sorted(displacements, key=lambda mv: abs(mv[0]) + abs(mv[1])):
+            shifted = padded[radius + row_mv : radius + row_mv + height, radius + col_mv : radius + col_mv + width]
+            sads = np.abs(current - shifted).reshape(len(block_rows), block_size, len(block_cols), block_size).sum(axis=(1, 3))
+            is_valid_row = (block_rows + row_mv >= 0) & (block_rows + row_mv <= height - block_size)
+            is_valid_col = (block_cols + col_mv >= 0) & (block_cols + col_mv <= width - block_size)
+            is_better = is_valid_row[:, np.newaxis] & is_valid_col & (sads < best_sads)
+            best_sads[is_better] = sads[is_better]
+            best_mvs[is_better] = (row_mv, col_mv)
+        self.sad_count += len(displacements) * best_sads.size
+        return best_mvs, best_sads
+
+    def refine(self, current: np.ndarray, reference: np.ndarray, block_size, mvs: np.ndarray, radius, limit):
+        # best candidate within radius of mvs that stays within limit and inside the plane
+        blocks = self.get_blocks(current, block_size)
+        rows = np.arange(blocks.shape[0])[:, np.newaxis] * block_size
+        cols = np.arange(blocks.shape[1])[np.newaxis, :] * block_size
+        rows, cols = np.broadcast_to(rows, blocks.shape[:2]), np.broadcast_to(cols, blocks.shape[:2])
+        best_mvs = mvs
+        best_sads = self.get_block_SADs(blocks, reference, rows + mvs[..., 0], cols + mvs[..., 1])
+        for row_move in range(-radius, radius + 1):
+            for col_move in range(-radius, radius + 1):
+                if row_move == 0 and col_move == 0:
+                    continue
+                candidates = mvs + (row_move, col_move)
+                candidate_rows, candidate_cols = rows + candidates[..., 0], cols + candidates[..., 1]
+                is_valid = (
+                    (np.abs(candidates) <= limit).all(axis=-1)
+                    & (candidate_rows >= 0) & (candidate_rows <= reference.shape[0] - block_size)
+                    & (candidate_cols >= 0) & (candidate_cols <= reference.shape[1] - block_size)
+                )
+                sads = np.full(rows.shape, np.iinfo(np.int32).max, dtype=np.int64)
+                sads[is_valid] = self.get_block_SADs(blocks[is_valid], reference, candidate_rows[is_valid], candidate_cols[is_valid])
+                is_better = self.is_better(sads, candidates, best_sads, best_mvs)
+                best_sads = np.where(is_better, sads, best_sads)
+                best_mvs = np.where(is_better[..., np.newaxis], candidates, best_mvs)
+        return best_mvs, best_sads
+
+    def refine_half_pel_frame(self, current: np.ndarray, ref_frame: ReferenceFrame, block_size, mvs: np.ndarray, sads: np.ndarray):
+        # every block of a reference frame is refined, the frames are compared afterwards
+        if not self.config.FMEEnable:
+            return mvs, sads
+        frame_seqs = np.zeros(sads.shape, dtype=np.int64)
+        return self.refine_half_pel(current, ref_frame.signed_FME_frame[np.newaxis], frame_seqs, block_size, mvs, sads)
+
+    def select_best_frame(self, frame_results):
+        # lowest SAD over the reference frames, then the closest mv, then the first frame searched
+        best_mvs, best_sads = frame_results[0]
+        frame_seqs = np.zeros(best_sads.shape, dtype=np.int64)
+        for frame_seq, (mvs, sads) in enumerate(frame_results[1:], start=1):
+            is_better = self.is_better(sads, mvs, best_sads, best_mvs)
+            frame_seqs[is_better] = frame_seq
+            best_sads = np.where(is_better, sads, best_sads)
+            best_mvs = np.where(is_better[..., np.newaxis], mvs, best_mvs)
+        return frame_seqs, best_mvs[..., 0], best_mvs[..., 1], best_sads
+
+
+class SeededMotionField(PyramidMotionField):
+    """
+    Motion field of the second pass of multi-pass rate control, from the tables of the first
+    pass. In every reference frame, every block and sub-block only checks the 3x3 candidates
+    around its first pass mv, then with FMEEnable the half-pel candidates around the best. The
+    second pass references are coded at another qp, so the mvs move a bit.
+    """
+    def __init__(self, config: CodecConfig, frame: ReferenceFrame, previous_frames: Deque[ReferenceFrame], seed_tables) -> None:
+        self.config = config
+        self.scale = 2 if self.config.FMEEnable else 1
+        self.sad_count = 0
+        self.tables = dict()
+        for block_size, (_, row_mvs, col_mvs, _) in seed_tables.items():
+            # integer mvs below the half-pel ones, still inside the frame
+            seed_mvs = np.stack([row_mvs, col_mvs], axis=-1) // self.scale
+            frame_results = []
+            for ref_frame in previous_frames:
+                mvs, sads = self.refine(frame.signed_data, ref_frame.signed_data, block_size, seed_mvs, 1, self.config.block_search_offset)
+                frame_results.append(self.refine_half_pel_frame(frame.signed_data, ref_frame, block_size, mvs, sads))
+            self.tables[block_size] = self.select_best_frame(frame_results)
@@ -0,0 +1,70 @@
+from concurrent.futures import ProcessPoolExecutor
+from PixelPerfect.CodecConfig import CodecConfig
+from PixelPerfect.Encoder import VideoEncoder
+from PixelPerfect.FileIO import YuvFile, read_frames
+
+
+def encode_frames(height, width, config: CodecConfig, source_path, start, stop, frame_seq):
+    # frame_seq is the position of start in the stream, it decides the frame types
+    encoder = VideoEncoder(height, width, config)
+    encoder.frame_seq = frame_seq
+    packets = []
+    for frame in read_frames(source_path, height, width, config, start=start, stop=stop):
+        packets.append((encoder.process(frame), encoder.frame_bitrate))
+    encoder.close()
+    return packets
+
+
+class ParallelVideoEncoder:
+    """
+    Encodes every GOP of a file in its own process and returns the packets in order, the same
+    packets a single VideoEncoder would produce. GOPs are only independent when nothing is
+    carried from one to the next: i_Period > 0, rate control without a first pass
+    (RCflag <= 1), and nRefFrames == 1, as the first P frames of a GOP otherwise still
+    reference the frame before its I frame. With ChromaEnable, rate control holds the chroma
+    bits of the frames of the previous GOP back from the luma budget, so it needs RCflag == 0.
+    Other configurations are encoded serially.
+    """
+    def __init__(self, height, width, config: CodecConfig, max_workers=None) -> None:
+        self.height = height
+        self.width = width
+        self.config = config
+        self.max_workers = max_workers
+        self.bitrate = 0
+        self.frame_bitrate = 0
+
+    def has_independent_gops(self):
+        if self.config.ChromaEnable and self.config.RCflag > 0:
+            return False
+        return self.config.i_Period > 0 and self.config.RCflag <= 1 and self.config.nRefFrames == 1
+
+    def get_gops(self, start, stop):
+        # frame ranges and stream position of every GOP, frame types count from start like VideoEncoder
+        if not self.has_independent_gops():
+            return [(start, stop, 0)]
+        return [
+            (gop_start, min(gop_start + self.config.i_Period, stop), gop_start - start)
+            for gop_start in range(start, stop, self.config.i_Period)
+        ]
+
+    def process(self, source_path, start=0, stop=None):
+        # yields the compressed data of every frame from start to stop, in order
+        frame_count = len(YuvFile(source_path, self.height, self.width))
+        stop = frame_count if stop is None else min(stop, frame_count)
+        gops = self.get_gops(start, stop)
+        if len(gops) == 1:
+            yield from self.collect(encode_frames(self.height, self.width, self.config, source_path, *gops[0]))
+            return
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            jobs = [
+                executor.submit(encode_frames, self.height, self.width, self.config, source_path, *gop)
+                for gop in gops
+            ]
+            for job in jobs:
+                yield from self.collect(job.result())
+
+    def collect(self, packets):
+        for compressed_data, frame_bitrate in packets:
+            self.frame_bitrate = frame_bitrate
+            self.bitrate += frame_bitrate
+            yield compressed_data
@@ -59,3 +59,34 @@ class ResidualProcessor:
         # original = idct(idct(data.T, type =2,norm='ortho').T, norm='ortho')
         # original = np.rint(original)
         return original
+
+    # region Batch
+    # the batch variants work on (N, block_size, block_size) stacks, every block with its own qp
+
+    def get_quant_matrices(self, qps, is_sub_blocks) -> np.ndarray:
+        return np.stack([
+            self.get_quant_matrix(int(qp), bool(is_sub_block))
+            for qp, is_sub_block in zip(qps, is_sub_blocks)
+        ])
+
+    def batch_dct_transform(self, residuals: np.ndarray):
+        transform = dctn(residuals, type=2, norm="ortho", axes=(-2, -1))
+        transform = np.rint(transform)
+        return transform
+
+    def batch_quantization(self, dct: np.ndarray, qps, is_sub_blocks):
+        quant_matrices = self.get_quant_matrices(qps, is_sub_blocks)
+        quantized = np.divide(dct, quant_matrices)
+        quantized = np.rint(quantized)
+        return quantized
+
+    def batch_de_quantization(self, data: np.ndarray, qps, is_sub_blocks):
+        quant_matrices = self.get_quant_matrices(qps, is_sub_blocks)
+        original = np.multiply(data, quant_matrices)
+        return original
+
+    def batch_de_dct(self, data: np.ndarray):
+        original = idctn(data, type=2, norm="ortho", axes=(-2, -1))
+        return original
+
+    # endregion
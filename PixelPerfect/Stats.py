@@ -0,0 +1,141 @@
+"""
+Optional per-frame statistics of VideoEncoder and VideoDecoder. Coders carry stats = None unless
+enable_stats was called, so a disabled coder only pays an attribute check at each timed method.
+Stage times are exclusive: a timed method called from another one is not counted twice. Search,
+VBS and bit counters are only kept by the encoder.
+"""
+import functools
+import json
+import time
+from PixelPerfect import ExpGolomb
+
+
+def timed(stage):
+    # the method time goes to stage, minus the time spent in nested timed methods
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.stats is None:
+                return method(self, *args, **kwargs)
+            self.stats.start(stage)
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.stats.stop()
+        return wrapper
+    return decorator
+
+
+class FrameStats:
+    def __init__(self) -> None:
+        self.frame_seq = None
+        self.is_p_frame = None
+        self.total_time = 0.0
+        self.stage_times = dict()
+        # per search, "normal", "pyramid", "seeded", "fast" or "epzs": block SADs computed, and positions searched
+        # (every candidate scored by the batched searches, the start and every move of the fast searches)
+        self.sad_evaluations = dict()
+        self.candidates_visited = dict()
+        self.vbs_trials = 0
+        self.vbs_wins = 0
+        # residual, descriptors and chroma are the bits frame_bitrate counts, mv and mode split the
+        # descriptors by their Exp-Golomb sizes before RLE, qp is the u8 per row of the bitstream
+        self.bits = {"residual": 0, "descriptors": 0, "mv": 0, "mode": 0, "qp": 0, "chroma": 0}
+        self.row_qps = []
+
+    def add_search(self, search, sad_evaluations, candidates_visited):
+        self.sad_evaluations[search] = self.sad_evaluations.get(search, 0) + sad_evaluations
+        self.candidates_visited[search] = self.candidates_visited.get(search, 0) + candidates_visited
+
+    def merge(self, other):
+        # counters of a slice coded on a worker
+        for stage, seconds in other.stage_times.items():
+            self.stage_times[stage] = self.stage_times.get(stage, 0.0) + seconds
+        for search in other.sad_evaluations:
+            self.add_search(search, other.sad_evaluations[search], other.candidates_visited[search])
+        self.vbs_trials += other.vbs_trials
+        self.vbs_wins += other.vbs_wins
+        for name, bits in other.bits.items():
+            self.bits[name] += bits
+
+    def to_dict(self):
+        return {
+            "frame_seq": self.frame_seq,
+            "frame_type": "P" if self.is_p_frame else "I",
+            "total_time": self.total_time,
+            "stage_times": self.stage_times,
+            "sad_evaluations": self.sad_evaluations,
+            "candidates_visited": self.candidates_visited,
+            "vbs_trials": self.vbs_trials,
+            "vbs_wins": self.vbs_wins,
+            "vbs_win_rate": self.vbs_wins / self.vbs_trials if self.vbs_trials else None,
+            "bits": self.bits,
+            "row_qps": self.row_qps,
+        }
+
+
+class CodecStats:
+    """
+    Statistics of every frame processed so far in frames, the frame being processed in frame.
+    With a stream_path every finished frame is also written there as one JSON line.
+    """
+    def __init__(self, stream_path=None) -> None:
+        self.frames = []
+        self.frame = FrameStats()
+        self.stages = []
+        self.stream = open(stream_path, "w") if stream_path else None
+
+    def __getstate__(self):
+        # slice workers get a copy without the stream and the frames before
+        state = self.__dict__.copy()
+        state["stream"] = None
+        state["frames"] = []
+        return state
+
+    def start(self, stage):
+        now = time.perf_counter()
+        if self.stages:
+            self.add_time(self.stages[-1][0], now - self.stages[-1][1])
+        self.stages.append([stage, now])
+
+    def stop(self):
+        now = time.perf_counter()
+        stage, start = self.stages.pop()
+        self.add_time(stage, now - start)
+        if self.stages:
+            self.stages[-1][1] = now
+
+    def add_time(self, stage, seconds):
+        self.frame.stage_times[stage] = self.frame.stage_times.get(stage, 0.0) + seconds
+
+    def start_frame(self):
+        self.frame = FrameStats()
+        self.frame_start = time.perf_counter()
+
+    def end_frame(self, frame_seq, is_p_frame, row_qps):
+        self.frame.total_time = time.perf_counter() - self.frame_start
+        self.frame.frame_seq = frame_seq
+        self.frame.is_p_frame = is_p_frame
+        self.frame.row_qps = list(row_qps)
+        self.frame.bits["qp"] = 8 * len(row_qps)
+        self.frames.append(self.frame)
+        if self.stream is not None:
+            self.stream.write(json.dumps(self.frame.to_dict()) + "\n")
+            self.stream.flush()
+
+    def count_block(self, residual_bitrate, descriptor_bitrate, descriptors, is_p_frame, has_vbs_trial, use_sub_blocks):
+        bits = self.frame.bits
+        bits["residual"] += residual_bitrate
+        bits["descriptors"] += descriptor_bitrate
+        for seq, descriptor in enumerate(descriptors):
+            # every P residual starts with its two mv differences
+            is_mv = is_p_frame and seq % (len(descriptors) // (4 if use_sub_blocks else 1)) < 2
+            bits["mv" if is_mv else "mode"] += ExpGolomb.get_code_length(descriptor)
+        if has_vbs_trial:
+            self.frame.vbs_trials += 1
+            self.frame.vbs_wins += bool(use_sub_blocks)
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
@@ -0,0 +1,114 @@
+"""
+Runs grids of encodes, one process per point, and keeps the results in an on-disk cache. An
+entry is named after the hash of the source file content, the config and the frame count, so a
+sweep only encodes the points it has never seen.
+"""
+import hashlib
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from PixelPerfect.CodecConfig import CodecConfig
+from PixelPerfect.Encoder import VideoEncoder
+from PixelPerfect.FileIO import read_frames, get_test_result_path
+
+# bump when the coded output of a config changes, older entries are then never read
+CACHE_VERSION = 4
+# fields that do not change the coded output
+IGNORED_FIELDS = ("DisplayBlocks", "DisplayMvAndMode", "DisplayRefFrames", "need_display", "SliceWorkers")
+
+
+def get_config_key(config: CodecConfig):
+    fields = {name: value for name, value in vars(config).items() if name not in IGNORED_FIELDS}
+    return json.dumps(fields, sort_keys=True, default=str)
+
+
+def encode_point(source_path, height, width, config: CodecConfig, stop):
+    # bitrate, per-frame bitrates and PSNRs of the reconstruction, and the encode time
+    encoder = VideoEncoder(height, width, config)
+    frame_bitrates, psnrs = [], []
+    encode_time = 0
+    for frame in read_frames(source_path, height, width, config, stop=stop):
+        start = time.time()
+        encoder.process(frame)
+        encode_time += time.time() - start
+        frame_bitrates.append(int(encoder.frame_bitrate))
+        psnrs.append(float(frame.PSNR(encoder.previous_frames[-1])))
+    encoder.close()
+    return {
+        "bitrate": int(encoder.bitrate),
+        "frame_bitrates": frame_bitrates,
+        "psnrs": psnrs,
+        "encode_time": encode_time,
+    }
+
+
+class SweepRunner:
+    def __init__(self, cache_dir=None, max_workers=None) -> None:
+        self.cache_dir = cache_dir or get_test_result_path("sweep_cache")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.max_workers = max_workers
+        self.file_hashes = dict()
+
+    @staticmethod
+    def get_grid(config: CodecConfig, videos, **axes):
+        """
+        Every combination of videos and axis values, as (video, config) points. videos are
+        (source_path, height, width) tuples and every point gets its own config, built again from
+        the arguments of config so that derived fields such as sub_block_size follow the axes.
+        Axes must be CodecConfig arguments.
+        """
+        points = []
+        names = list(axes)
+        for video in videos:
+            for values in itertools.product(*axes.values()):
+                points.append((video, config.get_changed_config(**dict(zip(names, values)))))
+        return points
+
+    def get_file_hash(self, path):
+        # hashed once per runner, unless the file changes
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        if key not in self.file_hashes:
+            digest = hashlib.sha1()
+            with open(path, "rb") as file:
+                for chunk in iter(lambda: file.read(1 << 20), b""):
+                    digest.update(chunk)
+            self.file_hashes[key] = digest.hexdigest()
+        return self.file_hashes[key]
+
+    def get_cache_path(self, video, config: CodecConfig, stop):
+        source_path, height, width = video
+        key = json.dumps([CACHE_VERSION, self.get_file_hash(source_path), height, width, stop, get_config_key(config)])
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".json")
+
+    def run(self, points, stop=None):
+        # results of every point in order, stop limits the number of frames encoded
+        paths = [self.get_cache_path(video, config, stop) for video, config in points]
+        results = [None] * len(points)
+        missing = []
+        for seq, path in enumerate(paths):
+            if os.path.exists(path):
+                with open(path) as file:
+                    results[seq] = json.load(file)
+            else:
+                missing.append(seq)
+        if len(missing) > 1:
+            with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+                jobs = [executor.submit(encode_point, *points[seq][0], points[seq][1], stop) for seq in missing]
+                for seq, job in zip(missing, jobs):
+                    results[seq] = job.result()
+                    self.store(paths[seq], results[seq])
+        for seq in missing:
+            if results[seq] is None:
+                results[seq] = encode_point(*points[seq][0], points[seq][1], stop)
+                self.store(paths[seq], results[seq])
+        return results
+
+    def store(self, path, result):
+        # written aside and renamed, concurrent sweeps never read half an entry
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump(result, file)
+        os.replace(temp_path, path)
@@ -1,9 +1,13 @@
 from PixelPerfect.Decoder import VideoDecoder
 from PixelPerfect.Encoder import VideoEncoder
+from PixelPerfect.ParallelEncoder import ParallelVideoEncoder
+from PixelPerfect.Bitstream import BitstreamWriter
 from PixelPerfect.CodecConfig import CodecConfig
 from PixelPerfect.FileIO import get_media_file_path, dump_json, read_frames, read_json
+from PixelPerfect.Sweep import SweepRunner
 import matplotlib.pyplot as plt
 import time
+import os
 
 videos = {
     "garden": ("garden.yuv", 240, 352),
@@ -13,32 +17,19 @@ videos = {
     "QCIF": ("QCIF.yuv", 144, 176),
 }
 
+def get_video(video_name):
+    filename, height, width = videos[video_name]
+    return get_media_file_path(filename), height, width
+
 def plot_a_RD_to_bitrate_curve(video_name, config: CodecConfig, label: str, show_time=False, display=True):
     qps = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
     last_seq = 10
-    R_D = []
-    total_time = 0
-    filename, height, width = videos[video_name]
-    for qp in qps:
-        config.qp = qp
-        encoder = VideoEncoder(height, width, config)
-        decoder = VideoDecoder(height, width, config)
-        psnr_sum = 0
-        for seq, frame in enumerate(read_frames(get_media_file_path(filename), height, width, config)):
-            t1 = time.time()
-            compressed_data = encoder.process(frame)
-            total_time += time.time() - t1
-            decoded_frame = decoder.process(compressed_data)
-            decoded_frame.display()
-            psnr_sum += frame.PSNR(decoded_frame)
-            if seq == last_seq:
-                print(f"{encoder.bitrate} {frame.PSNR(decoded_frame)}")
-                R_D.append((encoder.bitrate, (psnr_sum) / (last_seq + 1)))
-                break
+    results = SweepRunner().run(SweepRunner.get_grid(config, [get_video(video_name)], qp=qps), stop=last_seq + 1)
+    R_D = [(result["bitrate"], sum(result["psnrs"]) / (last_seq + 1)) for result in results]
     x = [R_D[i][0] for i in range(len(qps))]
     y = [R_D[i][1] for i in range(len(qps))]
     if show_time:
-        average_time = total_time / len(qps)
+        average_time = sum(result["encode_time"] for result in results) / len(qps)
         label += f" (average time: {average_time:.2f}s)"
     plt.plot(x, y, label=label, linewidth=0.5)
 
@@ -91,30 +82,16 @@ def get_iframe_threshold():
         FMEEnable=True,
         FastME=1,
         FastME_LIMIT=16,
+        i_Period=-1,
     )
-    filename, height, width = videos["CIF"]
-    frame_type_data = dict()
-    for i_p in [-1]:
-        qp_data = dict()
-        config.i_Period = i_p
-        threshold = dict()
-        for qp in range(12):
-            config.qp = qp
-            encoder = VideoEncoder(height, width, config)
-            total_frames = 0
-            p = []
-            i = []
-            for seq, frame in enumerate(read_frames(get_media_file_path(filename), height, width, config)):
-                compressed_data = encoder.process(frame)
-                print(encoder.frame_bitrate)
-                if seq % 7 == 0:
-                    i.append(encoder.frame_bitrate)
-                else:
-                    p.append(encoder.frame_bitrate)
-                prev_bit = encoder.bitrate
-                total_frames += 1
-            threshold[qp] = (min(i) + max(p))/2
-        print(threshold)
+    qps = list(range(12))
+    results = SweepRunner().run(SweepRunner.get_grid(config, [get_video("CIF")], qp=qps))
+    threshold = dict()
+    for qp, result in zip(qps, results):
+        i = [bitrate for seq, bitrate in enumerate(result["frame_bitrates"]) if seq % 7 == 0]
+        p = [bitrate for seq, bitrate in enumerate(result["frame_bitrates"]) if seq % 7 != 0]
+        threshold[qp] = (min(i) + max(p))/2
+    print(threshold)
 
 
 def create_e1_table():
@@ -142,22 +119,21 @@ def create_e1_table():
         FastME=1,
         FastME_LIMIT=16,
     )
+    video_names = ["CIF", "QCIF"]
+    i_periods = [1, -1]
+    qps = list(range(12))
+    points = SweepRunner.get_grid(config, [get_video(video_name) for video_name in video_names], i_Period=i_periods, qp=qps)
+    results = iter(SweepRunner().run(points))
     video_data = dict()
-    for video_name in ["CIF", "QCIF"]:
+    for video_name in video_names:
         filename, height, width = videos[video_name]
         frame_type_data = dict()
-        for i_p in [1, -1]:
+        for i_p in i_periods:
             qp_data = dict()
-            config.i_Period = i_p
-            for qp in range(12):
-                config.qp = qp
-                encoder = VideoEncoder(height, width, config)
-                total_frames = 0
-                for seq, frame in enumerate(read_frames(get_media_file_path(filename), height, width, config)):
-                    compressed_data = encoder.process(frame)
-                    total_frames += 1
-                bit_count = encoder.bitrate
-                bit_count /= total_frames
+            for qp in qps:
+                result = next(results)
+                bit_count = result["bitrate"]
+                bit_count /= len(result["frame_bitrates"])
                 bit_count /= (height / 16)
                 print(f"{video_name} i_p={i_p} qp={qp} bit_count={bit_count}")
                 qp_data[qp] = bit_count
@@ -388,6 +364,49 @@ def a3_e2_test_part2():
         plt.legend(loc='best')
     plt.show()
     plt.savefig("PSNR_perframe_QCIF.png")
+def parallel_encoder_test(stream_dir="."):
+    # ParallelVideoEncoder must give the packets of VideoEncoder bit for bit, whether or not it splits the GOPs
+    filename, height, width = videos["QCIF"]
+    last_seq = 8
+    for RCflag, ChromaEnable in [(0, False), (1, False), (0, True), (1, True)]:
+        config = CodecConfig(
+            block_size=16,
+            i_Period=3,
+            VBSEnable=True,
+            ChromaEnable=ChromaEnable,
+            RCflag=RCflag,
+            RCTable=read_json("e1_table.json")["QCIF"],
+            targetBR=960,
+            fps=30,
+            total_frames=last_seq + 1,
+            filename="QCIF",
+        )
+        # both streams go through BitstreamWriter, every field of every packet has to be the same
+        serial_path = os.path.join(stream_dir, f"serial_{RCflag}_{int(ChromaEnable)}.bin")
+        parallel_path = os.path.join(stream_dir, f"parallel_{RCflag}_{int(ChromaEnable)}.bin")
+        encoder = VideoEncoder(height, width, config)
+        serial_bitrates = []
+        with BitstreamWriter(serial_path, encoder) as writer:
+            for seq, frame in enumerate(read_frames(get_media_file_path(filename), height, width, config)):
+                if seq > last_seq:
+                    break
+                writer.write(encoder.process(frame))
+                serial_bitrates.append(encoder.frame_bitrate)
+        encoder.close()
+        parallel_encoder = ParallelVideoEncoder(height, width, config)
+        parallel_bitrates = []
+        with BitstreamWriter(parallel_path, VideoEncoder(height, width, config)) as writer:
+            for compressed_data in parallel_encoder.process(get_media_file_path(filename), stop=last_seq + 1):
+                writer.write(compressed_data)
+                parallel_bitrates.append(parallel_encoder.frame_bitrate)
+        with open(serial_path, "rb") as serial_file, open(parallel_path, "rb") as parallel_file:
+            identical = parallel_file.read() == serial_file.read()
+        os.remove(serial_path)
+        os.remove(parallel_path)
+        assert identical, f"RCflag={RCflag}, ChromaEnable={ChromaEnable}"
+        assert parallel_bitrates == serial_bitrates, f"RCflag={RCflag}, ChromaEnable={ChromaEnable}"
+        print(f"RCflag={RCflag}, ChromaEnable={ChromaEnable}: {encoder.bitrate} bits, identical")
+
 def run_e1():
     # create_e1_table()
     # config = CodecConfig(
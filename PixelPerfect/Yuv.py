@@ -4,36 +4,47 @@ from math import log10, sqrt, isclose
 from PixelPerfect.CodecConfig import CodecConfig
 
 class YuvBlock:
-    def __init__(self, data: np.ndarray, block_size: int, row: int, col: int) -> None:
+    # a search creates a block per candidate, slots keep them small
+    __slots__ = ("data", "block_size", "row", "col", "signed_data")
+
+    def __init__(self, data: np.ndarray, block_size: int, row: int, col: int, signed_data: np.ndarray = None) -> None:
         self.data: np.ndarray = data
         self.block_size: int = block_size
         self.row: int = row
         self.col: int = col
+        # int16 view of data, blocks read from a ReferenceFrame take it from the frame's cached plane
+        self.signed_data: np.ndarray = signed_data
+
+    def get_signed_data(self) -> np.ndarray:
+        if self.signed_data is None:
+            return self.data.astype(np.int16)
+        return self.signed_data
 
     def add_residual(self, residual: np.ndarray):
         self.data = self.data + residual
+        self.signed_data = None
 
     def get_mae(self, ref_block) -> float:
-        return np.mean(np.abs(self.data.astype(np.int16) - ref_block.data.astype(np.int16)))
+        # the integer sum divided once is exactly np.mean, without its overhead
+        return self.get_SAD(ref_block) / self.data.size
 
     def get_SAD(self, ref_block) -> float:
-        return np.sum(np.abs(self.data.astype(np.int16) - ref_block.data.astype(np.int16)))
+        return np.abs(self.get_signed_data() - ref_block.get_signed_data()).sum()
 
     def get_residual(self, ref_block) -> np.ndarray:
-        return self.data.astype(np.int16) - ref_block.data.astype(np.int16)
+        return self.get_signed_data() - ref_block.get_signed_data()
 
     def get_sub_blocks(self):
         sub_block_size = self.block_size // 2
         for start_row in range(0, self.block_size, sub_block_size):
             for start_col in range(0, self.block_size, sub_block_size):
+                area = (slice(start_row, start_row + sub_block_size), slice(start_col, start_col + sub_block_size))
                 yield YuvBlock(
-                    self.data[
-                        start_row : start_row + sub_block_size,
-                        start_col : start_col + sub_block_size,
-                    ],
+                    self.data[area],
                     sub_block_size,
                     self.row + start_row,
                     self.col + start_col,
+                    None if self.signed_data is None else self.signed_data[area],
                 )
 
 class YuvFrame:
@@ -61,12 +72,14 @@ class YuvFrame:
         self.config = config
         self.block_size = self.config.block_size
         pad_height, pad_width = YuvFrame.get_pad_size(*self.data.shape, self.block_size)
-        self.data = np.pad(
-            self.data,
-            ((0, pad_height), (0, pad_width)),
-            mode="constant",
-            constant_values=128,
-        )
+        # frames that are already block aligned keep their data, which may be a view into a file
+        if pad_height or pad_width:
+            self.data = np.pad(
+                self.data,
+                ((0, pad_height), (0, pad_width)),
+                mode="constant",
+                constant_values=128,
+            )
         self.height, self.width = self.data.shape
         if self.config.DisplayRefFrames:
             self.frame_seq2color = dict()
@@ -74,6 +87,13 @@ class YuvFrame:
             for i in range(self.config.nRefFrames):
                 self.frame_seq2color[i] = i * interval
 
+    def take_blocks(self, rows, cols, block_size) -> np.ndarray:
+        # (N, block_size, block_size) stack of the blocks at rows and cols
+        offsets = np.arange(block_size)
+        rows = np.asarray(rows, dtype=np.int64)[:, np.newaxis, np.newaxis] + offsets[:, np.newaxis]
+        cols = np.asarray(cols, dtype=np.int64)[:, np.newaxis, np.newaxis] + offsets
+        return self.data[rows, cols]
+
     def get_psnr(self, reference_frame):
         return cv2.PSNR(self.data, reference_frame.data)
 
@@ -131,6 +151,21 @@ class ConstructingFrame(YuvFrame):
             int(col) : int(col) + block.block_size,
         ] = block.data.clip(0, 255)
 
+    def put_blocks(self, rows, cols, blocks: np.ndarray):
+        # blocks is a (N, block_size, block_size) stack, rows and cols their top left corners
+        offsets = np.arange(blocks.shape[-1])
+        rows = np.asarray(rows, dtype=np.int64)[:, np.newaxis, np.newaxis] + offsets[:, np.newaxis]
+        cols = np.asarray(cols, dtype=np.int64)[:, np.newaxis, np.newaxis] + offsets
+        self.data[rows, cols] = blocks.clip(0, 255)
+
+    def snapshot(self, row, col, block_size):
+        # copy of a region, rollback puts it back
+        return row, col, self.data[row : row + block_size, col : col + block_size].copy()
+
+    def rollback(self, snapshot):
+        row, col, data = snapshot
+        self.data[row : row + data.shape[0], col : col + data.shape[1]] = data
+
     def get_block(self, row, col, is_sub_block) -> YuvBlock:
         block_size = self.config.sub_block_size if is_sub_block else self.block_size
         return YuvBlock(
@@ -189,32 +224,53 @@ class ConstructingFrame(YuvFrame):
 class ReferenceFrame(YuvFrame):
     def __init__(self, config: CodecConfig, data: np.ndarray) -> None:
         super().__init__(config, data)
-        if self.config.FMEEnable:
-            self.create_FME_ref()
+        # the half-pel plane is only built once a fractional position is read
+        self._FME_frame = None
+        # int16 copies of data and of the half-pel plane, made once for every block read from the frame
+        self._signed_data = None
+        self._signed_FME_frame = None
+        # signed_data and its 2x, 4x ... downsampled planes
+        self._pyramid = []
+        # U and V ReferenceFrames when ChromaEnable is set
+        self.chroma = None
         self.cross_area_moves = [(-1, 0), (0, -1), (1, 0), (0, 1)]
 
+    def get_uncached_copy(self):
+        # same pixels without the derived planes, they are cheaper to build again than to pickle
+        return ReferenceFrame(self.config, self.data)
+
+    @property
+    def FME_frame(self) -> np.ndarray:
+        if self._FME_frame is None:
+            self.create_FME_ref()
+        return self._FME_frame
+
+    @property
+    def signed_data(self) -> np.ndarray:
+        if self._signed_data is None:
+            self._signed_data = self.data.astype(np.int16)
+        return self._signed_data
+
+    @property
+    def signed_FME_frame(self) -> np.ndarray:
+        if self._signed_FME_frame is None:
+            self._signed_FME_frame = self.FME_frame.astype(np.int16)
+        return self._signed_FME_frame
+
     def create_FME_ref(self):
         x, y = self.data.shape
-        self.FME_frame = np.zeros((2 * x - 1, 2 * y - 1), dtype=np.uint8)
-        for i in range(x):
-            for j in range(y):
-                self.FME_frame[2 * i, 2 * j] = self.data[i, j]
-                # Calculate the average of neighbors and store it in the result array
-                if i < x - 1:
-                    self.FME_frame[2 * i + 1, 2 * j] = round(
-                        self.data[i, j] / 2
-                        + self.data[i + 1, j] / 2
-                    )
-                if j < y - 1:
-                    self.FME_frame[2 * i, 2 * j + 1] = round(
-                        self.data[i, j] / 2
-                        + self.data[i, j + 1] / 2
-                    )
-                if i < x - 1 and j < y - 1:
-                    self.FME_frame[2 * i + 1, 2 * j + 1] = round(
-                        self.data[i + 1, j + 1] / 2
-                        + self.data[i, j] / 2
-                    )
+        data = self.data.astype(np.uint16)
+        FME_frame = np.zeros((2 * x - 1, 2 * y - 1), dtype=np.uint8)
+        FME_frame[::2, ::2] = self.data
+        # average of the two neighbours, ties are rounded to even like round()
+        FME_frame[1::2, ::2] = np.rint((data[:-1, :] + data[1:, :]) / 2)
+        FME_frame[::2, 1::2] = np.rint((data[:, :-1] + data[:, 1:]) / 2)
+        FME_frame[1::2, 1::2] = np.rint((data[:-1, :-1] + data[1:, 1:]) / 2)
+        self._FME_frame = FME_frame
+
+    @staticmethod
+    def is_integer_position(row, col) -> bool:
+        return float(row).is_integer() and float(col).is_integer()
 
     def get_ref_blocks_in_cross_area(self, center_block: YuvBlock) -> YuvBlock:
         block_size = center_block.block_size
@@ -226,120 +282,53 @@ class ReferenceFrame(YuvFrame):
                 c = int(col * 2 + dcol)
                 if r < 0 or r + block_size * 2 > self.FME_frame.shape[0] or c < 0 or c + block_size * 2 > self.FME_frame.shape[1]:
                     continue
-                yield YuvBlock(
-                    self.FME_frame[
-                        r : r + block_size * 2 : 2,
-                        c : c + block_size * 2 : 2,
-                    ],
-                    block_size,
-                    r / 2,
-                    c / 2,
-                )
+                area = (slice(r, r + block_size * 2, 2), slice(c, c + block_size * 2, 2))
+                yield YuvBlock(self.FME_frame[area], block_size, r / 2, c / 2, self.signed_FME_frame[area])
         else:   
             for drow, dcol in self.cross_area_moves:
                 r = row + drow
                 c = col + dcol
                 if r < 0 or r + block_size > self.height or c < 0 or c + block_size > self.width:
                     continue
-                yield YuvBlock(
-                    self.data[
-                        r : r + block_size,
-                        c : c + block_size,
-                    ],
-                    block_size,
-                    r,
-                    c,
-                )
+                area = (slice(r, r + block_size), slice(c, c + block_size))
+                yield YuvBlock(self.data[area], block_size, r, c, self.signed_data[area])
     
-    def get_ref_blocks_in_offset_area(self, center_block: YuvBlock) -> YuvBlock:
-        block_size = center_block.block_size
-        row = center_block.row
-        col = center_block.col
-        offset = self.config.block_search_offset
-        if self.config.FMEEnable:
-            row = int(row * 2)
-            col = int(col * 2)
-            offset *= 2
-            row_start = max(0, row - offset)
-            row_end = min(self.FME_frame.shape[0] - block_size * 2, row + offset)
-            col_start = max(0, col - 2 * offset)
-            col_end = min(self.FME_frame.shape[1] - block_size * 2, col + offset)
-            for r in range(row_start, row_end + 1):
-                for c in range(col_start, col_end + 1): 
-                    yield YuvBlock(
-                        self.FME_frame[
-                            r : r + block_size * 2 : 2,
-                            c : c + block_size * 2 : 2,
-                        ],
-                        block_size,
-                        r / 2,
-                        c / 2,
-                    )
-        else:
-            row_start = max(0, row - offset)
-            row_end = min(self.height - block_size, row + offset)
-            col_start = max(0, col - offset)
-            col_end = min(self.width - block_size, col + offset)
-            for r in range(row_start, row_end + 1):
-                for c in range(col_start, col_end + 1):
-                    yield YuvBlock(
-                        self.data[
-                            r : r + block_size,
-                            c : c + block_size,
-                        ],
-                        block_size,
-                        r,
-                        c,
-                    )
-        
+    def get_pyramid(self, levels):
+        # int16 planes of every level, each one the rounded 2x2 average of the level before
+        if not self._pyramid:
+            self._pyramid.append(self.signed_data)
+        while len(self._pyramid) <= levels:
+            plane = self._pyramid[-1]
+            height, width = plane.shape[0] // 2, plane.shape[1] // 2
+            sums = plane[: 2 * height, : 2 * width].reshape(height, 2, width, 2).sum(axis=(1, 3))
+            self._pyramid.append(((sums + 2) // 4).astype(np.int16))
+        return self._pyramid[: levels + 1]
+
     def get_blocks(self) -> YuvBlock:
         for start_row in range(0, self.height, self.block_size):
             for start_col in range(0, self.width, self.block_size):
-                yield YuvBlock(
-                    self.data[
-                        start_row : start_row + self.block_size,
-                        start_col : start_col + self.block_size,
-                    ],
-                    self.block_size,
-                    start_row,
-                    start_col,
-                )
+                area = (slice(start_row, start_row + self.block_size), slice(start_col, start_col + self.block_size))
+                yield YuvBlock(self.data[area], self.block_size, start_row, start_col, self.signed_data[area])
 
     def get_block(self, row, col, is_sub_block) -> YuvBlock:
         block_size = self.config.sub_block_size if is_sub_block else self.block_size
-        if self.config.FMEEnable:
-            data = self.FME_frame[
-                int(row * 2) : int(row * 2) + block_size * 2 : 2,
-                int(col * 2) : int(col * 2) + block_size * 2 : 2,
-            ]
-        else:
-            data = self.data[
-                row : row + block_size,
-                col : col + block_size,
-            ]
-        return YuvBlock(
-                data,
-                block_size,
-                row,
-                col,
+        if self.config.FMEEnable and not ReferenceFrame.is_integer_position(row, col):
+            area = (
+                slice(int(row * 2), int(row * 2) + block_size * 2, 2),
+                slice(int(col * 2), int(col * 2) + block_size * 2, 2),
             )
+            return YuvBlock(self.FME_frame[area], block_size, row, col, self.signed_FME_frame[area])
+        area = (slice(int(row), int(row) + block_size), slice(int(col), int(col) + block_size))
+        return YuvBlock(self.data[area], block_size, row, col, self.signed_data[area])
 
     def get_block_by_mv(self, row, col, row_mv, col_mv, block_size: int) -> YuvBlock:
-        if self.config.FMEEnable:
+        if self.config.FMEEnable and not ReferenceFrame.is_integer_position(row + row_mv, col + col_mv):
             fme_row = int(row * 2 + row_mv * 2)
             fme_col = int(col * 2 + col_mv * 2)
-            data = self.FME_frame[
-                fme_row : fme_row + block_size * 2 : 2,
-                fme_col : fme_col + block_size * 2 : 2,
-            ]
-        else:
-            data = self.data[
-                row + row_mv : row + row_mv + block_size,
-                col + col_mv : col + col_mv + block_size,
-            ]
-        return YuvBlock(
-            data,
-            block_size,
-            row + row_mv,
-            col + col_mv,
-        )
\ No newline at end of file
+            area = (slice(fme_row, fme_row + block_size * 2, 2), slice(fme_col, fme_col + block_size * 2, 2))
+            return YuvBlock(self.FME_frame[area], block_size, row + row_mv, col + col_mv, self.signed_FME_frame[area])
+        area = (
+            slice(int(row + row_mv), int(row + row_mv) + block_size),
+            slice(int(col + col_mv), int(col + col_mv) + block_size),
+        )
+        return YuvBlock(self.data[area], block_size, row + row_mv, col + col_mv, self.signed_data[area])
\ No newline at end of file